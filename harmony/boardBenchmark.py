@@ -0,0 +1,59 @@
+import argparse
+import json
+from importlib.util import find_spec
+from time import perf_counter
+
+import dma.MechaCombat as mc
+
+
+QuantumSystem = mc.QuantumSystem
+
+
+def populateBoard(mechs, structures):
+    """ A game's setup: its state, `mechs` mechs split between two teams and `structures` terrain pieces """
+    mechModels = list(mc.MechFactories)
+    structureTypes = list(mc.StructureFactories)
+    mc.GameState.build_system()
+    for i in range(mechs):
+        mc.MechFactories[mechModels[i % len(mechModels)]](f"Mech{i}", f"Team{i % 2}")
+    for i in range(structures):
+        mc.StructureFactories[structureTypes[i % len(structureTypes)]](f"Structure{i}")
+
+
+def timeBoard(backend, batched, mechs, structures, repeats):
+    """ The fastest of `repeats` board setups onto a fresh graph, and the number of edges it wrote """
+    samples = []
+    for i in range(repeats):
+        QuantumSystem.reset(backend)
+        QuantumSystem.batch_writes = batched
+        start = perf_counter()
+        populateBoard(mechs, structures)
+        samples.append(perf_counter() - start)
+    return {"backend": backend, "batched": batched, "seconds": min(samples),
+            "edges": QuantumSystem.v().out().count()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='BoardBenchmark',
+        description='Times populating a MechaCombat board, writing each build_system call tree as one batch or edge '
+                    'by edge, on each graph backend')
+    parser.add_argument("--mechs", type=int, default=20)
+    parser.add_argument("--structures", type=int, default=40)
+    parser.add_argument("--backends", nargs="+", default=list(mc.GRAPH_BACKENDS))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for backend in args.backends:
+        if backend == "cog" and find_spec("cog") is None:
+            print("Skipping cog, cogdb is not installed")
+            continue
+        for batched in [False, True]:
+            results.append(timeBoard(backend, batched, args.mechs, args.structures, args.repeats))
+            print(f"{backend:8} {'batched' if batched else 'per edge':9} {1000 * results[-1]['seconds']:9.2f}ms "
+                  f"for {results[-1]['edges']} edges")
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(results, indent=2))
@@ -0,0 +1,114 @@
+import argparse
+import json
+import resource
+from time import perf_counter
+
+import observer  # Puts the observer notebooks on the import path
+from ipynb.fs.full.Observer import SessionReplay, CYCLE_TIMINGS
+from ipynb.fs.full.CalibratedObserver import CalibratedCaptureConfiguration, CalibratedObserver
+
+
+def loadMachine(name):
+    if name == "harmony":
+        from ipynb.fs.full.HarmonyMachine import HarmonyMachine
+        return HarmonyMachine
+    return CalibratedObserver
+
+
+def quantile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def stageLatencies():
+    """ Mean and p50/p90/p99 milliseconds of each cycle stage, over every sample of the run """
+    latencies = {}
+    for (stage, camera), series in sorted(CYCLE_TIMINGS.snapshot().items(), key=lambda item: (item[0][0], item[0][1] or "")):
+        samples = series["recent"]
+        if not samples:
+            continue
+        latencies[stage if camera is None else f"{stage}/{camera}"] = {
+            "count": series["count"],
+            "meanMs": 1000 * series["sum"] / series["count"],
+            "p50Ms": 1000 * quantile(samples, 0.5),
+            "p90Ms": 1000 * quantile(samples, 0.9),
+            "p99Ms": 1000 * quantile(samples, 0.99)}
+    return latencies
+
+
+def commitResults(cm, commitCycles):
+    """ What the run committed, comparable between runs: object ids are replaced by their order in memory """
+    return {
+        "commitCycles": commitCycles,
+        "memory": [
+            {"version": obj.version,
+             "changes": {camName: {"type": change.changeType, "box": change.clipBox}
+                         for camName, change in obj.changeSet.items()
+                         if change is not None and change.changeType not in [None, "delete"]}}
+            for obj in cm.memory]}
+
+
+def benchmarkSession(directory, machineClass, realTime=False):
+    replay = SessionReplay(directory, realTime=realTime)
+    CYCLE_TIMINGS.reset()
+    cc = replay.configuration(CalibratedCaptureConfiguration)
+    cm = machineClass(cc)
+    cm.trackMode()
+    commitCycles = []
+    failures = 0
+    start = perf_counter()
+    while not replay.exhausted:
+        memoryVersion = cm.memoryVersion
+        if cm.cycle() is not None:
+            failures += 1
+        if cm.memoryVersion != memoryVersion:
+            commitCycles.append(cm.cycleCounter)
+    elapsed = perf_counter() - start
+    replay.close()
+    return {
+        "session": directory,
+        "frames": replay.frameCount,
+        "cycles": cm.cycleCounter,
+        "failedCycles": failures,
+        "seconds": elapsed,
+        "cyclesPerSecond": cm.cycleCounter / elapsed if elapsed > 0 else 0,
+        "peakRssMb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": stageLatencies(),
+        **commitResults(cm, commitCycles)}
+
+
+def printReport(result):
+    print(f"{result['session']}: {result['cycles']} cycles over {result['frames']} frames in {result['seconds']:.2f}s "
+          f"= {result['cyclesPerSecond']:.2f} cycles/s, peak RSS {result['peakRssMb']:.0f}MB, "
+          f"{len(result['commitCycles'])} commits, {len(result['memory'])} objects, "
+          f"{result['failedCycles']} failed cycles")
+    print(f"    {'stage':24} {'count':>7} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9}")
+    for stage, latency in result["stages"].items():
+        print(f"    {stage:24} {latency['count']:7} {latency['meanMs']:8.2f}ms {latency['p50Ms']:8.2f}ms "
+              f"{latency['p90Ms']:8.2f}ms {latency['p99Ms']:8.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='CycleBenchmark',
+        description='Replays recorded sessions (see /calibrator/recording_start) through the observer cycle')
+    parser.add_argument("sessions", nargs="+", help="Session directories")
+    parser.add_argument("--machine", choices=["observer", "harmony"], default="observer",
+                        help="CalibratedObserver or HarmonyMachine")
+    parser.add_argument("--real-time", action="store_true",
+                        help="Replay at the recorded pace instead of as fast as possible")
+    parser.add_argument("--json", help="Also write the results to this file, e.g. to diff commits between runs")
+    args = parser.parse_args()
+
+    machineClass = loadMachine(args.machine)
+    # Keep every sample of the run for the latency quantiles
+    CYCLE_TIMINGS.window = None
+    if not args.real_time:
+        machineClass.minimumClassificationTime = 0
+    results = []
+    for session in args.sessions:
+        results.append(benchmarkSession(session, machineClass, realTime=args.real_time))
+        printReport(results[-1])
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(results, indent=2))
@@ -2,25 +2,35 @@ import os
 import cv2
 from math import ceil
 import numpy as np
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
 import base64
-import argparse
 import json
-from io import BytesIO
 from dataclasses import dataclass
 
 import threading
 import atexit
 from flask import Flask, Blueprint, render_template, Response, request, make_response, redirect, url_for
 from traceback import format_exc
+from time import perf_counter
 
 from observer.configurator import configurator, setConfiguratorApp
-from observer.calibrator import calibrator, CalibratedCaptureConfiguration, registerCaptureService, DATA_LOCK, CONSOLE_OUTPUT
-from ipynb.fs.full.HarmonyMachine import HarmonyMachine 
+# The observer modules import calibrator by its flat name, so that instance owns the cycle scheduler and DATA_LOCK
+from calibrator import calibrator, CalibratedCaptureConfiguration, registerCaptureService, DATA_LOCK, CONSOLE_OUTPUT, vStackImages, CYCLE_TIMINGS
+from observer.overlays import paintChanges
+from observer.templating import Template, TEMPLATES
+from observer.thumbnails import thumbnailURL, thumbnailResponse, UNVERSIONED_CACHE_CONTROL
+from observer.fragments import FragmentCache
+from observer.streams import StreamCache
+from observer.events import EVENTS, GAME_CHANGED, publishObserverEvents
+from observer.metrics import metricsResponse
+from observer.snapshots import SnapshotLog, SNAPSHOT_PATH
+from ipynb.fs.full.HarmonyMachine import HarmonyMachine, QuantumSystem
 
 
 harmony = Blueprint('harmony', __name__, template_folder='harmony_templates')
+fragments = FragmentCache()
+streams = StreamCache()
+publishObserverEvents(HarmonyMachine)
+SNAPSHOTS = SnapshotLog(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
 ROUND = 0
 
 
@@ -29,12 +39,36 @@ class GameState:
     state = "Add"
     round = 0
     declaredActions = {}
+    version = 0
+
+    @classmethod
+    def stateChanged(cls):
+        cls.version += 1
+        EVENTS.publish(GAME_CHANGED)
+        recordSnapshot()
+
+    @classmethod
+    def describe(cls):
+        return {"state": cls.state, "round": cls.round, "declaredActions": cls.declaredActions}
+
+    @classmethod
+    def restore(cls, described):
+        cls.state = described["state"]
+        cls.round = described["round"]
+        cls.declaredActions = described["declaredActions"]
+        cls.stateChanged()
 
     @classmethod
     def reset(cls):
         cls.round = 0
         cls.state = "Add"
         cls.declaredActions = {}
+        cls.stateChanged()
+
+    @classmethod
+    def declareAction(cls, objectId, action):
+        cls.declaredActions[objectId] = action
+        cls.stateChanged()
 
     @classmethod
     def nextState(cls, currentState=None):
@@ -55,24 +89,79 @@ class GameState:
             cls.declaredActions = {}
             cls.round += 1
         cls.state = newState
+        cls.stateChanged()
+
+    buttonTemplates = {
+        "Add": Template("""<input type="button" class="btn btn-info" name="commitAdditions" id="passive" hx-get="{harmonyURL}commit_additions" hx-target="#objectInteractor" value="Start Game">"""),
+        "Movement": Template("""<input type="button" class="btn btn-info" name="commitMovement" id="passive" hx-get="{harmonyURL}commit_movement" hx-target="#objectInteractor" value="Commit Movement">"""),
+        "Declare": Template("""<input type="button" class="btn btn-info" name="declareActions" id="passive" hx-get="{harmonyURL}declare_actions" hx-target="#objectInteractor" value="Declare Actions">"""),
+        "Resolve": Template("""<input type="button" class="btn btn-danger" name="resolveActions" id="passive" hx-get="{harmonyURL}resolve_actions" hx-target="#objectInteractor" value="Resolve Actions">""")}
 
     @classmethod
     def gameStateButton(cls):
-        gs = cls.state
-        if gs == "Add":
-            button = """<input type="button" class="btn btn-info" name="commitAdditions" id="passive" hx-get="{harmonyURL}commit_additions" hx-target="#objectInteractor" value="Start Game">"""
-        elif gs == "Movement":
-            button = """<input type="button" class="btn btn-info" name="commitMovement" id="passive" hx-get="{harmonyURL}commit_movement" hx-target="#objectInteractor" value="Commit Movement">"""
-        elif gs == "Declare":
-            button = """<input type="button" class="btn btn-info" name="declareActions" id="passive" hx-get="{harmonyURL}declare_actions" hx-target="#objectInteractor" value="Declare Actions">"""
-        elif gs == "Resolve":
-            button = """<input type="button" class="btn btn-danger" name="resolveActions" id="passive" hx-get="{harmonyURL}resolve_actions" hx-target="#objectInteractor" value="Resolve Actions">"""
-        return button.replace("{harmonyURL}", url_for(".buildHarmony"))
+        return cls.buttonTemplates[cls.state].render(harmonyURL=url_for(".buildHarmony"))
+
+
+def graphEdges():
+    if QuantumSystem.graph is None:
+        return None
+    return [[rel['from'], rel['edges'][0], rel['to']] for rel in QuantumSystem.whole_graph().all('e')['result']]
+
+
+def recordSnapshot(observer=None, event="objects-changed"):
+    """ Append whatever app.cm, the game state and the game graph changed to the snapshot log. Call with DATA_LOCK """
+    cm = getattr(app, "cm", None)
+    if SNAPSHOTS is None or event != "objects-changed" or type(cm) is not HarmonyMachine:
+        return
+    if observer is None or observer is cm:
+        SNAPSHOTS.recordObserver(cm, GameState.describe())
+
+
+def recordGraphWrite(operation, entity_id, edge_name, value):
+    """ Journal each game graph write for the next snapshot append, a QuantumSystem write listener """
+    if SNAPSHOTS is None:
+        return
+    if operation == "reset":
+        SNAPSHOTS.recordGraphReset(graphEdges() or [])
+    else:
+        SNAPSHOTS.recordGraphWrite(operation, (entity_id, edge_name, value))
+
+
+def restoreSnapshot(app):
+    """ Continue the game the snapshot log holds
+
+    The new app.cm has just taken the table as the cameras now see it as its reference, so pieces left in place are
+    not seen as changes.
+    """
+    if SNAPSHOTS is None:
+        return
+    start = perf_counter()
+    snapshot = SNAPSHOTS.load()
+    if snapshot.empty:
+        return
+    with DATA_LOCK:
+        if snapshot.graph is not None:
+            QuantumSystem.reset()
+            QuantumSystem.put_batch([tuple(edge) for edge in snapshot.graph])
+        app.cm.memory = snapshot.memory()
+        app.cm.memoryVersion += 1
+        if snapshot.game is not None:
+            GameState.restore(snapshot.game)
+        app.cm.stateChanged()
+    print(f"Restored {len(app.cm.memory)} objects from {SNAPSHOTS.path} in {perf_counter() - start:.3f}s")
+
+
+HarmonyMachine.stateListeners.append(recordSnapshot)
+QuantumSystem.write_listeners.append(recordGraphWrite)
+
+
+def harmonyVersion():
+    return (id(app.cm), app.cm.stateVersion, GameState.version)
 
 
 @harmony.route('/get_game_controller')
 def getGameController():
-    return GameState.gameStateButton()
+    return fragments.respond("get_game_controller", GameState.version, GameState.gameStateButton)
 
 
 @harmony.route('/commit_additions')
@@ -111,142 +200,80 @@ def imageToBase64(img):
 
 
 def renderConsole():
-    while True:
-        cam = list(app.cc.cameras.values())[0]
-        shape = (200, 400)
-        mid = [int(d / 2) for d in shape]
-        zeros = np.zeros(shape, dtype="uint8")
-
-        consoleImage = cv2.putText(zeros, f'Cycle {app.cm.cycleCounter}',
-            (50, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        consoleImage = cv2.putText(zeros, f'Mode: {app.cm.mode:7}',
-            (50, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        consoleImage = cv2.putText(zeros, f'Board State: {app.cm.state:10}',
-            (50, 105), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        consoleImage = cv2.putText(zeros, f'LO: {CONSOLE_OUTPUT}',
-            (50, 145), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        consoleImage = cv2.putText(zeros, f'Round: {GameState.round:3}-{GameState.state}',
-            (50, 185), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-
-        ret, consoleImage = cv2.imencode('.jpg', zeros)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + consoleImage.tobytes() + b'\r\n')
+    cam = list(app.cc.cameras.values())[0]
+    shape = (200, 400)
+    mid = [int(d / 2) for d in shape]
+    zeros = np.zeros(shape, dtype="uint8")
+    snapshot = app.cm.snapshot
+
+    consoleImage = cv2.putText(zeros, f'Cycle {snapshot.cycleCounter}',
+        (50, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    consoleImage = cv2.putText(zeros, f'Mode: {snapshot.mode:7}',
+        (50, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    consoleImage = cv2.putText(zeros, f'Board State: {snapshot.state:10}',
+        (50, 105), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    consoleImage = cv2.putText(zeros, f'LO: {CONSOLE_OUTPUT}',
+        (50, 145), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    consoleImage = cv2.putText(zeros, f'Round: {GameState.round:3}-{GameState.state}',
+        (50, 185), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+
+    return zeros
 
 
 @harmony.route('/harmony_console', methods=['GET'])
 def getConsoleImage():
-    return Response(renderConsole(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("console", renderConsole)
 
 
-def genCombinedCamerasView():
-    while True:
-        camImages = []
-        for camName in app.cc.cameras.keys():
-            camImage = app.cc.cameras[camName].mostRecentFrame.copy()
-            camImages.append(camImage)
-        camImage = vStackImages(camImages)
-        camImage = cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+def renderCombinedCamerasView():
+    camImages = []
+    for camName in app.cc.cameras.keys():
+        camImages.append(app.cc.cameras[camName].mostRecentFrame)
+    return vStackImages(camImages, size=[480, 640])
 
 
 @harmony.route('/combinedCameras')
 def combinedCamerasResponse():
-    return Response(genCombinedCamerasView(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("combinedCameras", renderCombinedCamerasView)
 
 
-def genCameraWithChangesView(camName):
-    camName = str(camName)
+def renderCameraWithChangesView(camName):
     cam = app.cc.cameras[camName]
-    while True:
-        if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-            print("Has changes")
-        if app.cm.lastClassification is not None:
-            print("Has class")
-        camImage = cam.cropToActiveZone(cam.mostRecentFrame.copy())
-        # Paint known objects blue
-        for memObj in app.cm.memory:
-            if memObj.changeSet[camName].changeType not in ['delete', None]:
-                memContour = np.array([memObj.changeSet[camName].changePoints], dtype=np.int32)
-                camImage = cv2.drawContours(camImage, memContour, -1, (255, 0, 0), -1)
-        # Paint last changes red
-        if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-            lastChange = app.cm.lastChanges.changeSet[camName]
-            if lastChange is not None and lastChange.changeType not in ['delete', None]:
-                lastChangeContour = np.array([lastChange.changePoints], dtype=np.int32)
-                camImage = cv2.drawContours(camImage, lastChangeContour, -1 , (0, 0, 255), -1)
-        # Paint classification green
-        if app.cm.lastClassification is not None and not app.cm.lastClassification.empty:
-            lastClass = app.cm.lastClassification.changeSet[camName]
-            if lastClass is not None and lastClass.changeType not in ['delete', None]:
-                lastClassContour = np.array([lastClass.changePoints], dtype=np.int32)
-                camImage = cv2.drawContours(camImage, lastClassContour, -1 , (0, 255, 0), -1)
-        camImage = cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+    camImage = cam.cropToActiveZone(cam.mostRecentFrame.copy())
+    camImage = paintChanges(app.cm.snapshot, camName, camImage)
+    return cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
 
 
 @harmony.route('/camWithChanges/<camName>')
 def cameraViewWithChangesResponse(camName):
     if camName == "VirtualMap":
-        return Response(minimapGenerator(), mimetype='multipart/x-mixed-replace; boundary=frame')
-    return Response(genCameraWithChangesView(camName), mimetype='multipart/x-mixed-replace; boundary=frame')
+        return streams.respond("minimap", renderMinimap)
+    camName = str(camName)
+    return streams.respond(("camWithChanges", camName), lambda: renderCameraWithChangesView(camName))
 
 
-def fullCam(camName):
-    camName = str(camName)
-    cam = app.cc.cameras[camName]
-    while True:
-        camImage = cam.mostRecentFrame.copy()
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+def renderFullCam(camName):
+    return app.cc.cameras[camName].mostRecentFrame
 
 
 @harmony.route('/fullCam/<camName>')
 def genFullCam(camName):
-    return Response(fullCam(camName), mimetype='multipart/x-mixed-replace; boundary=frame')
-
-
-def genCombinedCameraWithChangesView():
-    while True:
-        camImages = []
-        if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-            print("Has changes")
-        if app.cm.lastClassification is not None:
-            print("Has class")
-        for camName in app.cc.cameras.keys():
-            camImage = app.cc.cameras[camName].mostRecentFrame.copy()
-            # Paint known objects blue
-            for memObj in app.cm.memory:
-                if memObj.changeSet[camName].changeType not in ['delete', None]:
-                    memContour = np.array([memObj.changeSet[camName].changePoints], dtype=np.int32)
-                    camImage = cv2.drawContours(camImage, memContour, -1, (255, 0, 0), -1)
-            # Paint last changes red
-            if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-                lastChange = app.cm.lastChanges.changeSet[camName]
-                if lastChange is not None and lastChange.changeType not in ['delete', None]:
-                    lastChangeContour = np.array([lastChange.changePoints], dtype=np.int32)
-                    camImage = cv2.drawContours(camImage, lastChangeContour, -1 , (0, 0, 255), -1)
-            # Paint classification green
-            if app.cm.lastClassification is not None and not app.cm.lastClassification.empty:
-                lastClass = app.cm.lastClassification.changeSet[camName]
-                if lastClass is not None and lastClass.changeType not in ['delete', None]:
-                    lastClassContour = np.array([lastClass.changePoints], dtype=np.int32)
-                    camImage = cv2.drawContours(camImage, lastClassContour, -1 , (0, 255, 0), -1)
-            camImages.append(camImage)
-        camImage = vStackImages(camImages)
-        camImage = cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+    camName = str(camName)
+    return streams.respond(("fullCam", camName), lambda: renderFullCam(camName))
+
+
+def renderCombinedCameraWithChangesView():
+    camImages = []
+    for camName in app.cc.cameras.keys():
+        camImage = app.cc.cameras[camName].mostRecentFrame.copy()
+        camImage = paintChanges(app.cm.snapshot, camName, camImage)
+        camImages.append(camImage)
+    return vStackImages(camImages, size=[480, 640])
 
 
 @harmony.route('/combinedCamerasWithChanges')
 def combinedCamerasWithChangesResponse():
-    return Response(genCombinedCameraWithChangesView(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("combinedCamerasWithChanges", renderCombinedCameraWithChangesView)
 
 
 @harmony.route('/reset')
@@ -272,21 +299,35 @@ def controlSetTrack():
     return buildModeController()
 
 
-def buildModeController():
-    return """  <div class="btn-group" role="group" aria-label="harmony Capture Mode Control Buttons">
+modeControllerTemplate = Template("""  <div class="btn-group" role="group" aria-label="harmony Capture Mode Control Buttons">
                   <input type="radio" class="btn-check" name="btnradio" id="passive" autocomplete="off" {passiveChecked}hx-get="{harmonyURL}set_passive" hx-target="#modeController">
                   <label class="btn btn-outline-primary" for="passive">Passive</label>
                   <input type="radio" class="btn-check" name="btnradio" id="track" autocomplete="off" {activeChecked}hx-get="{harmonyURL}set_track" hx-target="#modeController">
                   <label class="btn btn-outline-primary" for="track">Track</label>
-                </div>""".replace(
-        "{harmonyURL}", url_for(".buildHarmony")).replace(
-        "{passiveChecked}", 'checked=""' if app.cm.mode == "passive" else '').replace(
-        "{activeChecked}", 'checked=""' if app.cm.mode == "track" else '')
+                </div>""")
+
+
+def buildModeController():
+    return modeControllerTemplate.render(
+        harmonyURL=url_for(".buildHarmony"),
+        passiveChecked='checked=""' if app.cm.snapshot.mode == "passive" else '',
+        activeChecked='checked=""' if app.cm.snapshot.mode == "track" else '')
+
+
+@harmony.route('/events')
+def getEvents():
+    return EVENTS.respond()
+
+
+@harmony.route('/metrics')
+def getMetrics():
+    return metricsResponse(
+        CYCLE_TIMINGS, streams, "harmony", getattr(app, "captureService", None), getattr(app, "readiness", None))
 
 
 @harmony.route('/get_mode_controller')
 def getModeController():
-    return buildModeController()
+    return fragments.respond("get_mode_controller", (id(app.cm), app.cm.stateVersion), buildModeController)
 
 
 @harmony.route('/')
@@ -296,46 +337,32 @@ def buildHarmony():
             app.cm = HarmonyMachine(app.cc)
             app.gm = GameState
             app.gm.reset()
-    with open("harmony_templates/Harmony.html", "r") as f:
-        template = f.read()
     cameraButtons = '<input type="button" value="Virtual Map" onclick="liveCameraClick(\'VirtualMap\')">' + ' '.join([f'''<input type="button" value="Camera {camName}" onclick="liveCameraClick('{camName}')">''' for camName in app.cc.cameras.keys()])
     defaultCam = [camName for camName, cam in app.cc.cameras.items()][0]
-    return template.replace(
-        "{defaultCamera}", defaultCam).replace(
-        "{cameraButtons}", cameraButtons).replace(
-        "{harmonyURL}", url_for('.buildHarmony')).replace(
-        "{configuratorURL}", '/configurator')
+    return TEMPLATES.render("harmony_templates/Harmony.html",
+        defaultCamera=defaultCam,
+        cameraButtons=cameraButtons,
+        harmonyURL=url_for('.buildHarmony'),
+        configuratorURL='/configurator')
 
 
 def captureToChangeRow(capture):
-    encodedBA = imageToBase64(capture.visual())
-    name = "None"
-    objType = "None"
-    center = ", ".join(["0", "0"])
-    health = ""
-    numHits = 0
-    for i in range(numHits):
-        health += "[x] "
-    for i in range(3 - numHits):
-        health += "[ ] "
-    with open("harmony_templates/TrackedObjectRow.html") as f:
-        changeRowTemplate = f.read()
+    harmonyURL = url_for(".buildHarmony")
     moveDistance = app.cm.cc.rsc.trackedObjectLastDistance(capture)
     moveDistance = "None" if moveDistance is None else f"{moveDistance:6.0f} mm"
-    changeRow = changeRowTemplate.replace(
-        "{objectName}", capture.oid).replace(
-        "{realCenter}", ", ".join([f"{dim:6.0f}" for dim in app.cm.cc.rsc.changeSetToRealCenter(capture)])).replace(
-        "{moveDistance}", moveDistance).replace(
-        "{harmonyURL}", url_for(".buildHarmony")).replace(
-        "{encodedBA}", imageToBase64(capture.visual())).replace(
-        "{actions}", "" if getattr(capture, 'objectType', None) != "Unit" else f"""<button class="btn btn-primary" hx-target="#objectInteractor" hx-get="{url_for(".buildHarmony")}objects/{capture.oid}/actions">Object Actions</button>""").replace(
-        "{edit}", "" if GameState.state != "Add" else f"""<button class="btn btn-info" hx-target="#objectInteractor" hx-get="{url_for(".buildHarmony")}objects/{capture.oid}">Edit</button>""")
-    return changeRow
+    return TEMPLATES.render("harmony_templates/TrackedObjectRow.html",
+        objectName=capture.oid,
+        realCenter=", ".join([f"{dim:6.0f}" for dim in app.cm.cc.rsc.changeSetToRealCenter(capture)]),
+        moveDistance=moveDistance,
+        harmonyURL=harmonyURL,
+        thumbnailURL=thumbnailURL(harmonyURL, capture),
+        actions="" if getattr(capture, 'objectType', None) != "Unit" else f"""<button class="btn btn-primary" hx-target="#objectInteractor" hx-get="{harmonyURL}objects/{capture.oid}/actions">Object Actions</button>""",
+        edit="" if GameState.state != "Add" else f"""<button class="btn btn-info" hx-target="#objectInteractor" hx-get="{harmonyURL}objects/{capture.oid}">Edit</button>""")
 
 
 def buildObjectTable(filter=None):
     changeRows = []
-    for capture in app.cm.memory:
+    for capture in app.cm.snapshot.memory:
         if filter is not None and getattr(capture, 'objectType', None) != filter:
             continue
         changeRows.append(captureToChangeRow(capture))
@@ -345,11 +372,11 @@ def buildObjectTable(filter=None):
 @harmony.route('/objects', methods=['GET'])
 def getObjectTable():
     filter = request.args.get('filter', None)
-    return buildObjectTable(filter=filter)
+    return fragments.respond(("objects", filter), harmonyVersion(), lambda: buildObjectTable(filter=filter))
 
 
 def buildObjectActionResolver():
-    return f"""<div id="objectActionResolver" hx-get="{url_for(".buildHarmony")}objects_filter" hx-trigger="every 1s"><p>{json.dumps(GameState.declaredActions, indent=4)}</p></div>"""
+    return f"""<div id="objectActionResolver" hx-get="{url_for(".buildHarmony")}objects_filter" hx-trigger="game-changed from:body, objects-changed from:body"><p>{json.dumps(GameState.declaredActions, indent=4)}</p></div>"""
 
 
 def buildObjectsFilter(filter=None):
@@ -371,8 +398,20 @@ def buildObjectsFilter(filter=None):
     elif filter == 'Unit':
         filterQuery = '?filter=Unit'
         unitSelected = ' checked="checked"'
-        
-    template = """
+
+    return objectsFilterTemplate.render(
+        harmonyURL=url_for(".buildHarmony"),
+        filter=filterQuery,
+        noneSelected=noneSelected,
+        terrainSelected=terrainSelected,
+        buildingSelected=buildingSelected,
+        unitSelected=unitSelected,
+        objectRows=buildObjectTable(filter))
+
+
+objectsFilterTemplate = Template("""<div class="row ">
+                <h2 class="mt-5">Object Tracker</h2>
+            </div>
     <div id="objectFilter"class="btn-group" role="group" aria-label="Objects Table Filter Select Buttons">
       <input type="radio" class="btn-check" name="objectFilterradio" id="None" autocomplete="off" {noneSelected} hx-get="{harmonyURL}objects_filter" hx-target="#objectInteractor">
       <label class="btn btn-outline-primary" for="None">None</label>
@@ -383,18 +422,7 @@ def buildObjectsFilter(filter=None):
       <input type="radio" class="btn-check" name="objectFilterradio" id="Unit" autocomplete="off" {unitSelected} hx-get="{harmonyURL}objects_filter?objectFilter=Unit" hx-target="#objectInteractor">
       <label class="btn btn-outline-primary" for="Unit">Unit</label>
     </div>
-    <div id="objectsTable" hx-get="{harmonyURL}objects{filter}" hx-trigger="every 1s">{objectRows}</div>"""
-    template = template.replace(
-        "{harmonyURL}", url_for(".buildHarmony")).replace(
-        "{filter}", filterQuery).replace(
-        "{noneSelected}", noneSelected).replace(
-        "{terrainSelected}", terrainSelected).replace(
-        "{buildingSelected}", buildingSelected).replace(
-        "{unitSelected}", unitSelected).replace(
-        "{objectRows}", buildObjectTable(filter))
-    return """<div class="row ">
-                <h2 class="mt-5">Object Tracker</h2>
-            </div>""" + template
+    <div id="objectsTable" hx-get="{harmonyURL}objects{filter}" hx-trigger="objects-changed from:body, game-changed from:body">{objectRows}</div>""")
 
 
 def getInteractor():
@@ -407,64 +435,81 @@ def getInteractor():
 @harmony.route('/objects_filter', methods=['GET'])
 def getObjectTableContainer():
     if GameState.state != "Resolve":
-        return buildObjectsFilter(request.args.get('objectFilter', None))
+        filter = request.args.get('objectFilter', None)
+        return fragments.respond(("objects_filter", filter), harmonyVersion(), lambda: buildObjectsFilter(filter))
     else:
-        return buildObjectActionResolver()
+        return fragments.respond("object_action_resolver", harmonyVersion(), buildObjectActionResolver)
     
     
 @harmony.route('/objects/<objectId>', methods=['GET'])
 def getObject(objectId):
     cap = None
-    for capture in app.cm.memory:
+    for capture in app.cm.snapshot.memory:
         if capture.oid == objectId:
             cap = capture
             break
     if cap is None:
         return f"{objectId} Not found", 404
 
-    objectName = cap.oid
-    with open("harmony_templates/TrackedObjectUpdater.html") as f:
-        template = f.read()
-    return template.replace(
-        "{harmonyURL}", url_for(".buildHarmony")).replace(
-        "{objectName}", cap.oid).replace(
-        "{objectSettings}", buildObjectSettings(cap))
+    return TEMPLATES.render("harmony_templates/TrackedObjectUpdater.html",
+        harmonyURL=url_for(".buildHarmony"),
+        objectName=cap.oid,
+        objectSettings=buildObjectSettings(cap))
+
+
+@harmony.route('/objects/<objectId>/<kind>.jpg', methods=['GET'])
+def getObjectThumbnail(objectId, kind):
+    cap = None
+    for capture in app.cm.snapshot.memory:
+        if capture.oid == objectId:
+            cap = capture
+            break
+    if cap is None or kind not in ["thumb", "icon"]:
+        return f"{objectId} {kind} Not found", 404
+    return thumbnailResponse(cap, kind)
 
 
 @harmony.route('/objects/<objectId>', methods=['POST'])
 def updateObjectSettings(objectId):
     cap = None
-    for capture in app.cm.memory:
+    for capture in app.cm.snapshot.memory:
         if capture.oid == objectId:
             cap = capture
             break
     if cap is None:
         return f"{objectId} Not found", 404
     newName = request.form["objectName"]
-    if newName != cap.oid:
-        cap.oid = newName
-    for key, value in request.form.items():
-        if key == 'objectName':
-            continue
-        setattr(cap, key, value)
+    with DATA_LOCK:
+        if newName != cap.oid:
+            cap.oid = newName
+        for key, value in request.form.items():
+            if key == 'objectName':
+                continue
+            setattr(cap, key, value)
+        if type(app.cm) is HarmonyMachine:
+            app.cm.followObject(cap)
+        app.cm.stateChanged()
     return buildObjectsFilter()
     
     
 @harmony.route('/objects/<objectId>', methods=['DELETE'])
 def deleteObjectSettings(objectId):
-    app.cm.deleteObject(objectId)
+    with DATA_LOCK:
+        app.cm.deleteObject(objectId)
     return buildObjectsFilter()
     
     
 @harmony.route('/objects/<objectId>/declare_attack/<targetId>', methods=['POST'])
 def declareAttackOnTarget(objectId, targetId):
-    GameState.declaredActions[objectId] = {"target": targetId}
+    with DATA_LOCK:
+        GameState.declareAction(objectId, {"target": targetId})
     return buildObjectActions(objectId)
     
     
 @harmony.route('/objects/<objectId>/declare_no_action', methods=['POST'])
 def declareNoAction(objectId):
-    GameState.declaredActions[objectId] = {}
+    with DATA_LOCK:
+        GameState.declareAction(objectId, {})
     return buildObjectActions(objectId)
 
 
@@ -487,7 +532,16 @@ def buildObjectSettings(obj):
         f"""<label for="{key}">{key}</label><input type="text" class="form-control" name="{key}" value="{value}">"""
         for key, value in settings.items()])
 
-    return """
+    return objectSettingsTemplate.render(
+        harmonyURL=url_for(".buildHarmony"),
+        objectName=obj.oid,
+        objectSettings=objectSettings,
+        terrainSelected=terrainSelected,
+        buildingSelected=buildingSelected,
+        unitSelected=unitSelected)
+
+
+objectSettingsTemplate = Template("""
     <select name="objectType" id="objectType" hx-target="#objectSettings" hx-post='{harmonyURL}objects/{objectName}/type'>
       <option value="None">None</option>
       <option value="Terrain" {terrainSelected}>Terrain</option>
@@ -495,19 +549,13 @@ def buildObjectSettings(obj):
       <option value="Unit" {unitSelected}>Unit</option>
     </select><br>
     {objectSettings}
-    """.replace(
-        "{harmonyURL}", url_for(".buildHarmony")).replace(
-        "{objectName}", obj.oid).replace(
-        "{objectSettings}", objectSettings).replace(
-        "{terrainSelected}", terrainSelected).replace(
-        "{buildingSelected}", buildingSelected).replace(
-        "{unitSelected}", unitSelected)
+    """)
 
 
 @harmony.route('/objects/<objectId>/settings', methods=['GET'])
 def getObjectSettings(objectId):
     cap = None
-    for capture in app.cm.memory:
+    for capture in app.cm.snapshot.memory:
         if capture.oid == objectId:
             cap = capture
             break
@@ -520,7 +568,7 @@ def getObjectSettings(objectId):
 def updateObjectType(objectId):
     newType = request.form["objectType"]
     cap = None
-    for capture in app.cm.memory:
+    for capture in app.cm.snapshot.memory:
         if capture.oid == objectId:
             cap = capture
             break
@@ -531,24 +579,25 @@ def updateObjectType(objectId):
 
     with DATA_LOCK:
         cap.objectType = newType
+        app.cm.stateChanged()
     return buildObjectSettings(cap)
     
 
 def buildObjectActions(objectId):
     cap = None
-    for capture in app.cm.memory:
+    for capture in app.cm.snapshot.memory:
         if capture.oid == objectId:
             cap = capture
             break
     if cap is None:
         return f"{objectId} Not found", 404
 
-    with open("harmony_templates/ObjectActionCard.html") as f:
-        cardTemplate = f.read()
+    harmonyURL = url_for(".buildHarmony")
+    cardTemplate = TEMPLATES.get("harmony_templates/ObjectActionCard.html")
     objActCards = []
     objMovement = app.cm.cc.rsc.trackedObjectLastDistance(cap)
     aMM = -1 if objMovement is None or objMovement < 10 else 1
-    for target in app.cm.memory:
+    for target in app.cm.snapshot.memory:
         if target.oid == cap.oid:
             continue
         else:
@@ -567,35 +616,33 @@ def buildObjectActions(objectId):
             tMM = app.cm.cc.rsc.trackedObjectLastDistance(target)
             tMM = -1 if tMM is None or tMM < 10 else 1
             targetNumber = int(cap.Skill) + aMM + tMM + 0 + rangeModifier
-            objActCards.append(cardTemplate.replace(
-                "{harmonyURL}", url_for(".buildHarmony")).replace(
-                "{objectName}", cap.oid).replace(
-                "{targetName}", target.oid).replace(
-                "{encodedBA}", imageToBase64(target.visual())).replace(
-                "{objectDistance}", f"{targetRange.capitalize()} ({targetDistance / 25.4:6.1f} in)").replace(
-                "{declare}", declare).replace(
-                "{skill}", cap.Skill).replace(
-                "{attackerMovementModifier}", str(aMM)).replace(
-                "{targetMovementModifier}", str(tMM)).replace(
-                "{range}", str(rangeModifier)).replace(
-                "{other}", "0").replace(
-                "{targetNumber}", str(targetNumber)))
+            objActCards.append(cardTemplate.render(
+                harmonyURL=harmonyURL,
+                objectName=cap.oid,
+                targetName=target.oid,
+                thumbnailURL=thumbnailURL(harmonyURL, target),
+                objectDistance=f"{targetRange.capitalize()} ({targetDistance / 25.4:6.1f} in)",
+                declare=declare,
+                skill=cap.Skill,
+                attackerMovementModifier=aMM,
+                targetMovementModifier=tMM,
+                range=rangeModifier,
+                other=0,
+                targetNumber=targetNumber))
 
     if GameState.state == "Declare":
         disabled = "" if cap.oid not in GameState.declaredActions or GameState.declaredActions[cap.oid] != {} else "disabled"
         objActCards.append(f"""
         <div class="row mb-1 border border-secondary border-2">
-            <input {disabled} type="button" class="btn btn-danger" value="Take No Action" id="no_action" hx-target="#objectInteractor" hx-post="{url_for(".buildHarmony")}objects/{cap.oid}/declare_no_action">
+            <input {disabled} type="button" class="btn btn-danger" value="Take No Action" id="no_action" hx-target="#objectInteractor" hx-post="{harmonyURL}objects/{cap.oid}/declare_no_action">
         </div>
-        """.replace("{harmonyURL}", url_for(".buildHarmony")).replace("{objectName}", cap.oid))
-    
-    with open("harmony_templates/ObjectActions.html") as f:
-        template = f.read()
-    return template.replace(
-        "{harmonyURL}", url_for(".buildHarmony")).replace(
-        "{objectName}", cap.oid).replace(
-        "{objectIcon}", imageToBase64(cap.icon)).replace(
-        "{objectActionCards}", "\n".join(objActCards))
+        """)
+
+    return TEMPLATES.render("harmony_templates/ObjectActions.html",
+        harmonyURL=harmonyURL,
+        objectName=cap.oid,
+        iconURL=thumbnailURL(harmonyURL, cap, kind="icon"),
+        objectActionCards="\n".join(objActCards))
 
 
 @harmony.route('/objects/<objectId>/actions', methods=['GET'])
@@ -603,19 +650,33 @@ def getObjectActions(objectId):
     return buildObjectActions(objectId)
 
 
-def minimapGenerator():
-    while True:
-        camImage = app.cm.cc.buildMiniMap(
-            blueObjects=app.cm.memory,
-            greenObjects=[app.cm.lastClassification] if app.cm.lastClassification is not None else None)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+def renderMinimap():
+    snapshot = app.cm.snapshot
+    return app.cm.cc.buildMiniMap(
+        blueObjects=snapshot.memory,
+        greenObjects=[snapshot.lastClassification] if snapshot.lastClassification is not None else None)
     
 
 @harmony.route('/minimap')
 def minimapResponse():
-    return Response(minimapGenerator(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("minimap", renderMinimap)
+
+
+@harmony.route('/graph.svg')
+def gameGraphResponse():
+    """ The game graph, or the part of it around `entity`, answering 304 while the client's copy is current """
+    entityId = request.args.get("entity") or None
+    depth = request.args.get("depth", 2, type=int)
+    etag = FragmentCache.etag(("graph", entityId, depth), QuantumSystem.version)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    elif QuantumSystem.graph is None:
+        return "No game graph", 404
+    else:
+        response = Response(QuantumSystem.render_image(entityId, depth, "svg"), mimetype="image/svg+xml")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = UNVERSIONED_CACHE_CONTROL
+    return response
 
 
 def setHarmonyApp(newApp):
@@ -626,13 +687,20 @@ def setHarmonyApp(newApp):
 if __name__ == "__main__":
     from flask import Flask, redirect, Response, Blueprint
     from observer.observer import CalibratedCaptureConfiguration, observer, configurator, registerCaptureService, setConfiguratorApp, setObserverApp
+    from observer.statics import mountStaticAssets
+    from observer.serving import runServer
+    from observer.startup import Readiness
     
+    def warmUp(app):
+        app.cc = CalibratedCaptureConfiguration()
+        app.cc.capture()
+        app.cm = HarmonyMachine(app.cc)
+        restoreSnapshot(app)
+        registerCaptureService(app)
+
     app = Flask(__name__)
-    app.cc = CalibratedCaptureConfiguration()
-    app.cc.capture()
     app.register_blueprint(configurator, url_prefix='/configurator')
     app.register_blueprint(harmony, url_prefix='/harmony')
-    app.cm = HarmonyMachine(app.cc)
     setConfiguratorApp(app)
     setObserverApp(app)
     
@@ -640,25 +708,8 @@ if __name__ == "__main__":
     def index():
         return redirect('/harmony', code=303)
     
-    @app.route('/bootstrap.min.css', methods=['GET'])
-    def getBSCSS():
-        with open("templates/bootstrap.min.css", "r") as f:
-            bscss = f.read()
-        return Response(bscss, mimetype="text/css")
-    
-    @app.route('/bootstrap.min.js', methods=['GET'])
-    def getBSJS():
-        with open("templates/bootstrap.min.js", "r") as f:
-            bsjs = f.read()
-        return Response(bsjs, mimetype="application/javascript")
-    
-    @app.route('/htmx.min.js', methods=['GET'])
-    def getHTMX():
-        with open("templates/htmx.min.js", "r") as f:
-            htmx = f.read()
-        return Response(htmx, mimetype="application/javascript")
-    
-    registerCaptureService(app)
+    mountStaticAssets(app)
+    Readiness().install(app).warmUp(app, warmUp)
     PORT = 7000
     print(f"Launching harmony Server on {PORT}")
-    app.run(host="0.0.0.0", port=PORT)
+    runServer(app, PORT)
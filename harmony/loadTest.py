@@ -0,0 +1,245 @@
+import argparse
+import json
+import threading
+from collections import defaultdict
+from statistics import mean
+from time import monotonic, sleep
+
+import requests
+
+
+POLLED_ENDPOINTS = ["/harmony/objects", "/harmony/get_mode_controller", "/harmony/get_game_controller"]
+EVENTS_ENDPOINT = "/harmony/events"
+# The fragments Harmony.html refetches on each event, and on connecting
+REFRESHED_ENDPOINTS = {
+    "objects-changed": ["/harmony/objects"],
+    "mode-changed": ["/harmony/get_mode_controller"],
+    "game-changed": ["/harmony/get_game_controller"]}
+RECONNECT_SECONDS = 3
+STREAM_ENDPOINTS = ["/harmony/harmony_console", "/harmony/camWithChanges/0", "/harmony/minimap"]
+METRICS_ENDPOINT = "/harmony/metrics"
+FRAME_BOUNDARY = b"--frame"
+
+
+def quantile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def readMetrics(baseURL):
+    """ The unlabelled samples of a Prometheus text exposition, e.g. process_cpu_seconds_total """
+    samples = {}
+    for line in requests.get(baseURL + METRICS_ENDPOINT, timeout=10).text.splitlines():
+        if line and not line.startswith("#") and "{" not in line:
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+class LoadResults:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.streamFrames = []
+        self.streamErrors = 0
+        self.events = 0
+
+    def request(self, endpoint, seconds, status):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][status] += 1
+
+    def stream(self, endpoint, frames, seconds):
+        with self.lock:
+            self.streamFrames.append((endpoint, frames, seconds))
+
+
+class BrowserSession:
+    """ One spectator's page: every stream and /harmony/events held open, refetching the fragments each event names
+
+    With a `pollInterval` the fragments are instead polled that often, as pages did before they listened for events.
+    Like a browser's cache, fetches revalidate with the ETag of the previous response.
+    """
+    def __init__(self, baseURL, results, stopping, polled, streams, pollInterval, streamQuery):
+        self.baseURL = baseURL
+        self.results = results
+        self.stopping = stopping
+        self.polled = polled
+        self.streams = streams
+        self.pollInterval = pollInterval
+        self.streamQuery = streamQuery
+        self.session = requests.Session()
+        self.etags = {}
+        self.responses = []
+        refresh = self.poll if pollInterval else self.listen
+        self.threads = [threading.Thread(target=refresh, daemon=True)] + [
+            threading.Thread(target=self.watch, args=(endpoint,), daemon=True) for endpoint in streams]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for response in self.responses:
+            response.close()
+
+    def fetch(self, endpoint):
+        headers = {"If-None-Match": self.etags[endpoint]} if endpoint in self.etags else {}
+        start = monotonic()
+        try:
+            response = self.session.get(self.baseURL + endpoint, headers=headers, timeout=30)
+            status = response.status_code
+            if "ETag" in response.headers:
+                self.etags[endpoint] = response.headers["ETag"]
+        except requests.RequestException:
+            status = "error"
+        self.results.request(endpoint, monotonic() - start, status)
+
+    def poll(self):
+        nextPoll = monotonic()
+        while not self.stopping.is_set():
+            for endpoint in self.polled:
+                self.fetch(endpoint)
+            nextPoll += self.pollInterval
+            self.stopping.wait(max(0, nextPoll - monotonic()))
+
+    def refresh(self, event):
+        for endpoint in REFRESHED_ENDPOINTS.get(event, []):
+            if endpoint in self.polled:
+                self.fetch(endpoint)
+
+    def listen(self):
+        """ Hold /harmony/events open like an EventSource, reconnecting when it drops """
+        while not self.stopping.is_set():
+            try:
+                response = self.session.get(self.baseURL + EVENTS_ENDPOINT, stream=True, timeout=30)
+                self.responses.append(response)
+                for event in REFRESHED_ENDPOINTS:
+                    self.refresh(event)
+                event = None
+                for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                    if self.stopping.is_set():
+                        return
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line == "" and event is not None:
+                        with self.results.lock:
+                            self.results.events += 1
+                        self.refresh(event)
+                        event = None
+            except Exception:
+                if self.stopping.is_set():
+                    return
+                with self.results.lock:
+                    self.results.streamErrors += 1
+            self.stopping.wait(RECONNECT_SECONDS)
+
+    def watch(self, endpoint):
+        frames = 0
+        start = monotonic()
+        tail = b""
+        try:
+            response = requests.get(f"{self.baseURL}{endpoint}?{self.streamQuery}", stream=True, timeout=30)
+            self.responses.append(response)
+            for chunk in response.iter_content(chunk_size=None):
+                if self.stopping.is_set():
+                    break
+                # Keep the end of the previous chunk so boundaries split across chunks are still counted
+                data = tail + chunk
+                frames += data.count(FRAME_BOUNDARY)
+                tail = data[-(len(FRAME_BOUNDARY) - 1):]
+        except Exception:
+            if not self.stopping.is_set():
+                with self.results.lock:
+                    self.results.streamErrors += 1
+        self.results.stream(endpoint, frames, monotonic() - start)
+
+
+def runLoad(baseURL, sessions, duration, polled, streams, pollInterval, streamQuery, ramp):
+    results = LoadResults()
+    stopping = threading.Event()
+    before = readMetrics(baseURL)
+    browsers = []
+    for i in range(sessions):
+        browsers.append(BrowserSession(baseURL, results, stopping, polled, streams, pollInterval, streamQuery))
+        browsers[-1].start()
+        sleep(ramp / sessions)
+    sleep(duration)
+    stopping.set()
+    after = readMetrics(baseURL)
+    for browser in browsers:
+        browser.stop()
+    for browser in browsers:
+        for thread in browser.threads:
+            thread.join(5)
+
+    elapsed = duration + ramp
+    report = {"sessions": sessions, "seconds": elapsed, "endpoints": {}, "streams": {}}
+    for endpoint, latencies in results.latencies.items():
+        statuses = results.statuses[endpoint]
+        report["endpoints"][endpoint] = {
+            "requests": len(latencies),
+            "notModified": statuses.get(304, 0),
+            "errors": sum(count for status, count in statuses.items() if status == "error" or status >= 400),
+            "p50Ms": 1000 * quantile(latencies, 0.5),
+            "p99Ms": 1000 * quantile(latencies, 0.99)}
+    byEndpoint = defaultdict(list)
+    for endpoint, frames, seconds in results.streamFrames:
+        byEndpoint[endpoint].append(frames / seconds if seconds > 0 else 0)
+    for endpoint, rates in byEndpoint.items():
+        report["streams"][endpoint] = {
+            "clients": len(rates), "meanFps": mean(rates), "minFps": min(rates), "p50Fps": quantile(rates, 0.5)}
+    report["streamErrors"] = results.streamErrors
+    report["events"] = results.events
+    report["serverCpuPercent"] = \
+        100 * (after["process_cpu_seconds_total"] - before["process_cpu_seconds_total"]) / elapsed
+    report["serverRssMb"] = after.get("process_resident_memory_bytes", 0) / 2 ** 20
+    if "harmony_cycles_total" in after:
+        report["cycleHz"] = (after["harmony_cycles_total"] - before["harmony_cycles_total"]) / elapsed
+        report["cycleOverruns"] = after["harmony_cycle_overruns_total"] - before["harmony_cycle_overruns_total"]
+    return report
+
+
+def printReport(report):
+    print(f"{report['sessions']} sessions over {report['seconds']:.0f}s")
+    print(f"    {'endpoint':40} {'requests':>9} {'304':>6} {'errors':>7} {'p50':>9} {'p99':>9}")
+    for endpoint, stats in report["endpoints"].items():
+        print(f"    {endpoint:40} {stats['requests']:9} {stats['notModified']:6} {stats['errors']:7} "
+              f"{stats['p50Ms']:7.1f}ms {stats['p99Ms']:7.1f}ms")
+    print(f"    {'stream':40} {'clients':>9} {'mean':>9} {'min':>9} {'p50':>9}")
+    for endpoint, stats in report["streams"].items():
+        print(f"    {endpoint:40} {stats['clients']:9} {stats['meanFps']:5.1f}fps {stats['minFps']:5.1f}fps "
+              f"{stats['p50Fps']:5.1f}fps")
+    print(f"    {report['events']} events received, {report['streamErrors']} stream errors, server CPU {report['serverCpuPercent']:.0f}%, "
+          f"RSS {report['serverRssMb']:.0f}MB, cycle rate {report.get('cycleHz', 0):.2f}Hz "
+          f"({report.get('cycleOverruns', 0):.0f} overruns)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='LoadTest',
+        description='Simulates spectator browsers against a running harmonyServer.py. Serve it from replayed or '
+                    'synthetic cameras (see observer/syntheticScene.py) for repeatable runs.')
+    parser.add_argument("--url", default="http://localhost:7000")
+    parser.add_argument("--sessions", nargs="+", type=int, default=[1, 5, 10],
+                        help="Browser session counts, each measured in its own run")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds each run holds all its sessions")
+    parser.add_argument("--ramp", type=float, default=5, help="Seconds over which a run's sessions connect")
+    parser.add_argument("--poll", nargs="*", default=POLLED_ENDPOINTS)
+    parser.add_argument("--poll-interval", type=float, default=0,
+                        help="Poll the fragments this many seconds apart instead of refetching them on each event")
+    parser.add_argument("--streams", nargs="*", default=STREAM_ENDPOINTS)
+    parser.add_argument("--stream-query", default="", help="e.g. width=320&quality=60&fps=5")
+    parser.add_argument("--json", help="Also write the reports to this file")
+    args = parser.parse_args()
+
+    reports = []
+    for sessions in args.sessions:
+        reports.append(runLoad(
+            args.url, sessions, args.duration, args.poll, args.streams, args.poll_interval, args.stream_query,
+            args.ramp))
+        printReport(reports[-1])
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(reports, indent=2))
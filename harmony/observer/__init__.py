@@ -5,6 +5,7 @@ oldPath = os.getcwd()
 try:
     observerDirectory = os.path.dirname(os.path.realpath(__file__))
     sys.path.insert(0, observerDirectory)
+    import notebooks  # Serves ipynb.fs.full imports from byte-compiled caches
     from ipynb.fs.full.CalibratedObserver import CalibratedCaptureConfiguration, CalibrationObserver, CalibratedObserver, TrackedObject
 finally:
     os.chdir(oldPath)
\ No newline at end of file
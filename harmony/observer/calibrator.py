@@ -2,35 +2,54 @@ import os
 import cv2
 from math import ceil
 import numpy as np
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
 import base64
-import argparse
 import json
-from io import BytesIO
+from datetime import datetime
 
+import notebooks  # Serves ipynb.fs.full imports from byte-compiled caches
+from ipynb.fs.full.Observer import vStackImages, CYCLE_TIMINGS, startRecording, stopRecording
 from ipynb.fs.full.CalibratedObserver import CalibratedCaptureConfiguration, CalibrationObserver, CalibratedObserver
+from overlays import paintChanges
+from templating import Template, TEMPLATES
+from thumbnails import thumbnailURL, thumbnailResponse
+from fragments import FragmentCache
+from streams import StreamCache
+from events import EVENTS, publishObserverEvents
+from serving import runServer
+from scheduler import CycleScheduler
+from metrics import metricsResponse
+from profiler import PROFILER
 
 import threading
 import atexit
-from flask import Blueprint, render_template, Response, request, make_response, redirect, url_for, current_app
+from flask import Blueprint, render_template, Response, request, make_response, redirect, url_for, current_app, jsonify
 from traceback import format_exc
 
 
 CONSOLE_OUTPUT = "No Output Yet"
 POOL_TIME = 0.1 #Seconds
+IDLE_POOL_TIME = float(os.getenv("OBSERVER_IDLE_POOL_TIME", "0.5")) #Seconds
+IDLE_AFTER = float(os.getenv("OBSERVER_IDLE_AFTER", "30")) #Seconds
+SESSIONS_DIRECTORY = os.getenv("OBSERVER_SESSIONS_DIRECTORY", "sessions")
 ENABLE_CYCLE = True
 DATA_LOCK = threading.Lock()
+CAPTURE_SERVICE = None
 
 app = None
 calibrator = Blueprint('calibrator', __name__, template_folder='templates')
+fragments = FragmentCache()
+streams = StreamCache()
+publishObserverEvents(CalibrationObserver)
+
+
+def wakeCaptureService(observer, event):
+    """ Return the capture service to its full rate when the capture mode changes """
+    if event == "mode-changed" and CAPTURE_SERVICE is not None:
+        CAPTURE_SERVICE.wake()
 
 
-captureTimer = threading.Timer(0,lambda x: None,())    
 def registerCaptureService(app):
-    def interrupt():
-        global captureTimer
-        captureTimer.cancel()
+    global CAPTURE_SERVICE
 
     def cycleMachine():
         global CONSOLE_OUTPUT
@@ -43,18 +62,19 @@ def registerCaptureService(app):
                 except Exception as e:
                     print(f"Unrecognized error: {e}")
                     CONSOLE_OUTPUT = e
-        # Set the next timeout to happen
-        captureTimer = threading.Timer(POOL_TIME, cycleMachine, ())
-        captureTimer.start()
-
-    def initialize():
-        global captureTimer
-        captureTimer = threading.Timer(POOL_TIME, cycleMachine, ())
-        captureTimer.start()
-
-    initialize()
-    # When you kill Flask (SIGTERM), cancels the timer
-    atexit.register(interrupt)
+
+    def boardIsStable():
+        return app.cm.snapshot.state == "idle"
+
+    if CAPTURE_SERVICE is not None:
+        CAPTURE_SERVICE.stop()
+    CAPTURE_SERVICE = CycleScheduler(
+        cycleMachine, rate=1 / POOL_TIME, idleRate=1 / IDLE_POOL_TIME, idleAfter=IDLE_AFTER, isIdle=boardIsStable)
+    if wakeCaptureService not in CalibrationObserver.stateListeners:
+        CalibrationObserver.stateListeners.append(wakeCaptureService)
+    app.captureService = CAPTURE_SERVICE.start()
+    # When you kill Flask (SIGTERM), stops the cycle thread
+    atexit.register(CAPTURE_SERVICE.stop)
     return app
 
 
@@ -63,139 +83,77 @@ def imageToBase64(img):
 
 
 def renderConsole():
-    while True:
-        cam = list(app.cc.cameras.values())[0]
-        shape = (170, 400)
-        mid = [int(d / 2) for d in shape]
-        zeros = np.zeros(shape, dtype="uint8")
-
-        consoleImage = cv2.putText(zeros, f'Cycle {app.cm.cycleCounter}',
-            (50, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        mode =  f'Mode: {app.cm.mode:7}' + ('' if app.cm.dowel_position is None else f'-{app.cm.dowel_position}')
-        consoleImage = cv2.putText(zeros, mode,
-            (50, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        consoleImage = cv2.putText(zeros, f'Board State: {app.cm.state:10}',
-            (50, 105), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        consoleImage = cv2.putText(zeros, f'LO: {CONSOLE_OUTPUT}',
-            (50, 145), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 255, 2, cv2.LINE_AA)
-
-        ret, consoleImage = cv2.imencode('.jpg', zeros)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + consoleImage.tobytes() + b'\r\n')
+    cam = list(app.cc.cameras.values())[0]
+    shape = (170, 400)
+    mid = [int(d / 2) for d in shape]
+    zeros = np.zeros(shape, dtype="uint8")
+    snapshot = app.cm.snapshot
+
+    consoleImage = cv2.putText(zeros, f'Cycle {snapshot.cycleCounter}',
+        (50, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    mode =  f'Mode: {snapshot.mode:7}' + ('' if app.cm.dowel_position is None else f'-{app.cm.dowel_position}')
+    consoleImage = cv2.putText(zeros, mode,
+        (50, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    consoleImage = cv2.putText(zeros, f'Board State: {snapshot.state:10}',
+        (50, 105), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    consoleImage = cv2.putText(zeros, f'LO: {CONSOLE_OUTPUT}',
+        (50, 145), cv2.FONT_HERSHEY_SIMPLEX, 0.5, 255, 2, cv2.LINE_AA)
+
+    return zeros
 
 
 @calibrator.route('/observer_console', methods=['GET'])
 def getConsoleImage():
-    return Response(renderConsole(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("console", renderConsole)
 
 
-def genCombinedCamerasView():
-    while True:
-        camImages = []
-        for camName in app.cc.cameras.keys():
-            camImage = app.cc.cameras[camName].mostRecentFrame.copy()
-            camImages.append(camImage)
-        camImage = vStackImages(camImages)
-        camImage = cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+def renderCombinedCamerasView():
+    camImages = []
+    for camName in app.cc.cameras.keys():
+        camImages.append(app.cc.cameras[camName].mostRecentFrame)
+    return vStackImages(camImages, size=[480, 640])
 
 
 @calibrator.route('/combinedCameras')
 def combinedCamerasResponse():
-    return Response(genCombinedCamerasView(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("combinedCameras", renderCombinedCamerasView)
 
 
-def genCameraWithChangesView(camName):
-    camName = str(camName)
+def renderCameraWithChangesView(camName):
     cam = app.cc.cameras[camName]
-    while True:
-        if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-            print("Has changes")
-        if app.cm.lastClassification is not None:
-            print("Has class")
-        camImage = cam.cropToActiveZone(cam.mostRecentFrame.copy())
-        # Paint known objects blue
-        for memObj in app.cm.memory:
-            if memObj.changeSet[camName].changeType not in ['delete', None]:
-                memContour = np.array([memObj.changeSet[camName].changePoints], dtype=np.int32)
-                camImage = cv2.drawContours(camImage, memContour, -1, (255, 0, 0), -1)
-        # Paint last changes red
-        if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-            lastChange = app.cm.lastChanges.changeSet[camName]
-            if lastChange is not None and lastChange.changeType not in ['delete', None]:
-                lastChangeContour = np.array([lastChange.changePoints], dtype=np.int32)
-                camImage = cv2.drawContours(camImage, lastChangeContour, -1 , (0, 0, 255), -1)
-        # Paint classification green
-        if app.cm.lastClassification is not None and not app.cm.lastClassification.empty:
-            lastClass = app.cm.lastClassification.changeSet[camName]
-            if lastClass is not None and lastClass.changeType not in ['delete', None]:
-                lastClassContour = np.array([lastClass.changePoints], dtype=np.int32)
-                camImage = cv2.drawContours(camImage, lastClassContour, -1 , (0, 255, 0), -1)
-        camImage = cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+    camImage = cam.cropToActiveZone(cam.mostRecentFrame.copy())
+    camImage = paintChanges(app.cm.snapshot, camName, camImage)
+    return cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
 
 
 @calibrator.route('/camWithChanges/<camName>')
 def cameraViewWithChangesResponse(camName):
-    return Response(genCameraWithChangesView(camName), mimetype='multipart/x-mixed-replace; boundary=frame')
+    camName = str(camName)
+    return streams.respond(("camWithChanges", camName), lambda: renderCameraWithChangesView(camName))
 
 
-def fullCam(camName):
-    camName = str(camName)
-    cam = app.cc.cameras[camName]
-    while True:
-        camImage = cam.mostRecentFrame.copy()
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+def renderFullCam(camName):
+    return app.cc.cameras[camName].mostRecentFrame
 
 
 @calibrator.route('/fullCam/<camName>')
 def genFullCam(camName):
-    return Response(fullCam(camName), mimetype='multipart/x-mixed-replace; boundary=frame')
-
-
-def genCombinedCameraWithChangesView():
-    while True:
-        camImages = []
-        if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-            print("Has changes")
-        if app.cm.lastClassification is not None:
-            print("Has class")
-        for camName in app.cc.cameras.keys():
-            camImage = app.cc.cameras[camName].mostRecentFrame.copy()
-            # Paint known objects blue
-            for memObj in app.cm.memory:
-                if memObj.changeSet[camName].changeType not in ['delete', None]:
-                    memContour = np.array([memObj.changeSet[camName].changePoints], dtype=np.int32)
-                    camImage = cv2.drawContours(camImage, memContour, -1, (255, 0, 0), -1)
-            # Paint last changes red
-            if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-                lastChange = app.cm.lastChanges.changeSet[camName]
-                if lastChange is not None and lastChange.changeType not in ['delete', None]:
-                    lastChangeContour = np.array([lastChange.changePoints], dtype=np.int32)
-                    camImage = cv2.drawContours(camImage, lastChangeContour, -1 , (0, 0, 255), -1)
-            # Paint classification green
-            if app.cm.lastClassification is not None and not app.cm.lastClassification.empty:
-                lastClass = app.cm.lastClassification.changeSet[camName]
-                if lastClass is not None and lastClass.changeType not in ['delete', None]:
-                    lastClassContour = np.array([lastClass.changePoints], dtype=np.int32)
-                    camImage = cv2.drawContours(camImage, lastClassContour, -1 , (0, 255, 0), -1)
-            camImages.append(camImage)
-        camImage = vStackImages(camImages)
-        camImage = cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+    camName = str(camName)
+    return streams.respond(("fullCam", camName), lambda: renderFullCam(camName))
+
+
+def renderCombinedCameraWithChangesView():
+    camImages = []
+    for camName in app.cc.cameras.keys():
+        camImage = app.cc.cameras[camName].mostRecentFrame.copy()
+        camImage = paintChanges(app.cm.snapshot, camName, camImage)
+        camImages.append(camImage)
+    return vStackImages(camImages, size=[480, 640])
 
 
 @calibrator.route('/combinedCamerasWithChanges')
 def combinedCamerasWithChangesResponse():
-    return Response(genCombinedCameraWithChangesView(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("combinedCamerasWithChanges", renderCombinedCameraWithChangesView)
 
 
 @calibrator.route('/set_passive')
@@ -213,8 +171,7 @@ def controlSetTrack(position):
     return buildModeController()
 
 
-def buildModeController():
-    return """
+modeControllerTemplate = Template("""
             <div class="btn-group" role="group" aria-label="Observer Capture Mode Control Buttons">
               <input type="radio" class="btn-check" name="btnradio" id="passive" autocomplete="off" {passiveChecked}hx-get="{calibratorURL}set_passive">
               <label class="btn btn-outline-primary" for="passive">Passive</label>
@@ -228,19 +185,74 @@ def buildModeController():
               <label class="btn btn-outline-primary" for="track_longs">Track Longs</label>
               <input type="radio" class="btn-check" name="btnradio" id="track_shorts" autocomplete="off" {shortsChecked}hx-get="{calibratorURL}set_track_shorts">
               <label class="btn btn-outline-primary" for="track_shorts">Track Short</label>
-            </div>""".replace(
-        "{calibratorURL}", url_for(".buildCalibrator")).replace(
-        "{passiveChecked}", 'checked=""' if app.cm.mode == "passive" else '').replace(
-        "{firstChecked}", 'checked=""' if app.cm.mode == "track" and app.cm.dowel_position == "first" else '').replace(
-        "{topChecked}", 'checked=""' if app.cm.mode == "track" and app.cm.dowel_position == "top" else '').replace(
-        "{hyposChecked}", 'checked=""' if app.cm.mode == "track" and app.cm.dowel_position == "hypos" else '').replace(
-        "{longsChecked}", 'checked=""' if app.cm.mode == "track" and app.cm.dowel_position == "longs" else '').replace(
-        "{shortsChecked}", 'checked=""' if app.cm.mode == "track" and app.cm.dowel_position == "shorts" else '')
+            </div>""")
+
+
+def buildModeController():
+    return modeControllerTemplate.render(
+        calibratorURL=url_for(".buildCalibrator"),
+        passiveChecked='checked=""' if app.cm.snapshot.mode == "passive" else '',
+        firstChecked='checked=""' if app.cm.snapshot.mode == "track" and app.cm.dowel_position == "first" else '',
+        topChecked='checked=""' if app.cm.snapshot.mode == "track" and app.cm.dowel_position == "top" else '',
+        hyposChecked='checked=""' if app.cm.snapshot.mode == "track" and app.cm.dowel_position == "hypos" else '',
+        longsChecked='checked=""' if app.cm.snapshot.mode == "track" and app.cm.dowel_position == "longs" else '',
+        shortsChecked='checked=""' if app.cm.snapshot.mode == "track" and app.cm.dowel_position == "shorts" else '')
+
+
+@calibrator.route('/events')
+def getEvents():
+    return EVENTS.respond()
+
+
+@calibrator.route('/cycle_stats')
+def getCycleStats():
+    if CAPTURE_SERVICE is None:
+        return "Capture service not running", 404
+    return jsonify(CAPTURE_SERVICE.stats())
+
+
+@calibrator.route('/metrics')
+def getMetrics():
+    return metricsResponse(CYCLE_TIMINGS, streams, "calibrator", CAPTURE_SERVICE, getattr(app, "readiness", None))
+
+
+@calibrator.route('/profile')
+def getProfile():
+    return PROFILER.respond()
+
+
+@calibrator.route('/cycle_pause')
+def pauseCycle():
+    CAPTURE_SERVICE.pause()
+    return jsonify(CAPTURE_SERVICE.stats())
+
+
+@calibrator.route('/cycle_resume')
+def resumeCycle():
+    CAPTURE_SERVICE.resume()
+    return jsonify(CAPTURE_SERVICE.stats())
+
+
+@calibrator.route('/recording_start')
+def startSessionRecording():
+    name = os.path.basename(request.args.get("name", "") or datetime.now().strftime("%Y%m%d-%H%M%S"))
+    with DATA_LOCK:
+        recorder = startRecording(os.path.join(SESSIONS_DIRECTORY, name), app.cc)
+    return jsonify({"recording": recorder.directory})
+
+
+@calibrator.route('/recording_stop')
+def stopSessionRecording():
+    with DATA_LOCK:
+        recorder = stopRecording()
+    if recorder is None:
+        return "Not recording", 404
+    return jsonify({"recording": recorder.directory, "frames": recorder.frameCount})
 
 
 @calibrator.route('/get_mode_controller')
 def getModeController():
-    return buildModeController()
+    return fragments.respond("get_mode_controller", (id(app.cm), app.cm.stateVersion), buildModeController)
 
 
 @calibrator.route('/commit_calibration')
@@ -268,28 +280,15 @@ def requestResetCalibrationObserver():
 def buildCalibrator():
     if type(app.cm) is not CalibrationObserver:
         resetCalibrationObserver()
-    with open("templates/Calibrator.html", "r") as f:
-        template = f.read()
     cameraButtons = ' '.join([f'''<input type="button" class="btn btn-primary" value="Camera {camName}" onclick="liveCameraClick('{camName}')">''' for camName in app.cc.cameras.keys()])
     defaultCam = [camName for camName, cam in app.cc.cameras.items()][0]
-    return template.replace(
-        "{defaultCamera}", defaultCam).replace(
-        "{cameraButtons}", cameraButtons).replace(
-        "{calibratorURL}", url_for('.buildCalibrator'))
+    return TEMPLATES.render("templates/Calibrator.html",
+        defaultCamera=defaultCam,
+        cameraButtons=cameraButtons,
+        calibratorURL=url_for('.buildCalibrator'))
 
 
-def captureToChangeRow(capture):
-    encodedBA = imageToBase64(capture.visual())
-    name = "None"
-    realTriangle = {camName: ctp[-1] for camName, ctp in capture.calibTriPts.items()}
-    center = ", ".join(["0", "0"])
-    health = ""
-    numHits = 0
-    for i in range(numHits):
-        health += "[x] "
-    for i in range(3 - numHits):
-        health += "[ ] "
-    changeRow = f"""
+changeRowTemplate = Template("""
         <div class="row mb-1">
             <div class="col">
                 <div class="row">
@@ -297,24 +296,42 @@ def captureToChangeRow(capture):
                 </div>
             </div>
             <div class="col">
-                <img class="img-fluid border border-secondary" alt="Capture Image" src="data:image/jpg;base64,{encodedBA}" style="border-radius: 10px;">
+                <img class="img-fluid border border-secondary" alt="Capture Image" src="{thumbnailURL}" style="border-radius: 10px;">
             </div>
         </div>
-        <hr class="mt-2 mb-3"/>"""
-    return changeRow
+        <hr class="mt-2 mb-3"/>""")
+
+
+def captureToChangeRow(capture):
+    realTriangle = {camName: ctp[-1] for camName, ctp in capture.calibTriPts.items()}
+    return changeRowTemplate.render(
+        realTriangle=realTriangle,
+        thumbnailURL=thumbnailURL(url_for(".buildCalibrator"), capture))
 
 
 def buildObjectTable():
     changeRows = []
-    print(f"Aware of {len(app.cm.memory)} objects")
-    for capture in app.cm.memory:
+    print(f"Aware of {len(app.cm.snapshot.memory)} objects")
+    for capture in app.cm.snapshot.memory:
         changeRows.append(captureToChangeRow(capture))
     return " ".join(changeRows)
 
 
 @calibrator.route('/objects', methods=['GET'])
 def getObjectTable():
-    return buildObjectTable()
+    return fragments.respond("objects", (id(app.cm), app.cm.stateVersion), buildObjectTable)
+
+
+@calibrator.route('/objects/<objectId>/<kind>.jpg', methods=['GET'])
+def getObjectThumbnail(objectId, kind):
+    cap = None
+    for capture in app.cm.snapshot.memory:
+        if capture.oid == objectId:
+            cap = capture
+            break
+    if cap is None or kind not in ["thumb", "icon"]:
+        return f"{objectId} {kind} Not found", 404
+    return thumbnailResponse(cap, kind)
 
 
 def setCalibratorApp(newApp):
@@ -324,11 +341,16 @@ def setCalibratorApp(newApp):
 
 if __name__ == "__main__":
     from flask import Flask
+    from startup import Readiness
+
+    def warmUp(app):
+        app.cc = CalibratedCaptureConfiguration()
+        app.cc.capture()
+        app.cm = CalibrationObserver(app.cc)
+        registerCaptureService(app)
+
     app = Flask(__name__)
-    app.cc = CalibratedCaptureConfiguration()
-    app.cc.capture()
     app.register_blueprint(calibrator, url_prefix='/calibrator')
-    app.cm = CalibrationObserver(cc)
 
     @app.route('/<page>')
     def getPage(page):
@@ -340,6 +362,6 @@ if __name__ == "__main__":
             page = "Not found!"
         return page
 
-    registerCaptureService(app)
+    Readiness().install(app).warmUp(app, warmUp)
     print(f"Launching Observer Server on Port 7000")
-    app.run(host="0.0.0.0", port=7000)
+    runServer(app, 7000)
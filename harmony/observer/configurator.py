@@ -1,15 +1,19 @@
 import json
-import cv2
 import numpy as np
-from flask import Blueprint, render_template, abort, request, Response, url_for
+from flask import Blueprint, render_template, abort, request, url_for
 
+import notebooks  # Serves ipynb.fs.full imports from byte-compiled caches
 from ipynb.fs.full.Observer import RemoteCamera
 from ipynb.fs.full.CalibratedObserver import CalibratedCaptureConfiguration, CalibrationObserver
 
 from calibrator import calibrator, registerCaptureService, setCalibratorApp
+from templating import TEMPLATES
+from serving import runServer
+from streams import StreamCache
 
 
 configurator = Blueprint('configurator', __name__, template_folder='templates')
+streams = StreamCache()
 configurator.register_blueprint(calibrator, url_prefix='/calibrator')
 
 
@@ -42,12 +46,9 @@ def buildConfigurator():
                 </div>
             </div>""")
 
-    with open("templates/Configurator.html") as f:
-        template = f.read()
-    
-    return template.replace(
-        "{configuratorURL}", url_for(".config")).replace(
-        "{cameraConfigRows}", "\n".join(cameraConfigRows))
+    return TEMPLATES.render("templates/Configurator.html",
+        configuratorURL=url_for(".config"),
+        cameraConfigRows="\n".join(cameraConfigRows))
 
     
 @configurator.route('/', methods=['GET'])
@@ -63,22 +64,19 @@ def updateConfig():
     return "success"
 
 
-def genCameraFullViewWithActiveZone(camName):
-    while True:
-        try:
-            cam = app.cc.cameras[str(camName)]
-            img = cam.drawActiveZone(cam.mostRecentFrame)
-            ret, img = cv2.imencode('.jpg', img)
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpg\r\n\r\n' + img.tobytes() + b'\r\n')
-        except Exception as e:
-            print(f"Failed genCameraFullViewWithActiveZone for {camName} -- {e}")
-            yield (b'--frame\r\nContent-Type: image/jpg\r\n\r\n\r\n')
+def renderCameraFullViewWithActiveZone(camName):
+    try:
+        cam = app.cc.cameras[camName]
+        return cam.drawActiveZone(cam.mostRecentFrame)
+    except Exception as e:
+        print(f"Failed renderCameraFullViewWithActiveZone for {camName} -- {e}")
+        return None
     
     
 @configurator.route('/camera/<camName>')
 def cameraActiveZoneWithObjects(camName):
-    return Response(genCameraFullViewWithActiveZone(str(camName)), mimetype='multipart/x-mixed-replace; boundary=frame')
+    camName = str(camName)
+    return streams.respond(("cameraActiveZone", camName), lambda: renderCameraFullViewWithActiveZone(camName))
 
 
 @configurator.route('/cam<camName>_activezone', methods=['POST'])
@@ -111,9 +109,7 @@ def updateCamType(camName):
 
 @configurator.route('/new_camera', methods=['GET'])
 def getNewCameraForm():
-    with open("templates/NewCamera.html", "r") as f:
-        template = f.read()
-    return template.replace("{configuratorURL}", url_for(".config"))
+    return TEMPLATES.render("templates/NewCamera.html", configuratorURL=url_for(".config"))
 
 
 @configurator.route('/new_camera', methods=['POST'])
@@ -150,12 +146,17 @@ def setConfiguratorApp(newApp):
 
 if __name__ == "__main__":
     from flask import Flask
+    from startup import Readiness
+
+    def warmUp(app):
+        app.cc = CalibratedCaptureConfiguration()
+        app.cc.capture()
+        app.cm = CalibrationObserver(app.cc)
+        registerCaptureService(app)
+
     app = Flask(__name__)
-    app.cc = CalibratedCaptureConfiguration()
-    app.cc.capture()
     app.register_blueprint(configurator, url_prefix='/configurator')
-    app.cm = CalibrationObserver(app.cc)
-    setCalibratorApp(app)
+    setConfiguratorApp(app)
 
     @app.route('/<page>')
     def getPage(page):
@@ -167,6 +168,6 @@ if __name__ == "__main__":
             page = "Not found!"
         return page
 
-    registerCaptureService(app)
+    Readiness().install(app).warmUp(app, warmUp)
     print(f"Launching Observer Server on Port 7000")
-    app.run(host="0.0.0.0", port=7000)
+    runServer(app, 7000)
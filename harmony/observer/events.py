@@ -0,0 +1,136 @@
+import asyncio
+import queue
+import threading
+
+from flask import Response, request
+
+from serving import LOOP_ENVIRON_KEY, ASYNC_BODY_ENVIRON_KEY
+
+
+OBJECTS_CHANGED = "objects-changed"
+MODE_CHANGED = "mode-changed"
+GAME_CHANGED = "game-changed"
+KEEPALIVE_SECONDS = 15
+CLIENT_BACKLOG = 32
+
+
+class LoopClient:
+    """ A client backlog living on the event loop serving it, filled from the dispatcher thread """
+    def __init__(self, loop):
+        self.loop = loop
+        self.messages = asyncio.Queue(maxsize=CLIENT_BACKLOG)
+
+    def put_nowait(self, message):
+        if self.messages.qsize() >= CLIENT_BACKLOG:
+            raise queue.Full
+        try:
+            self.loop.call_soon_threadsafe(self.put, message)
+        except RuntimeError:  # The loop has closed
+            raise queue.Full
+
+    def put(self, message):
+        if not self.messages.full():
+            self.messages.put_nowait(message)
+
+
+def formatEvent(event, data=""):
+    lines = [f"event: {event}"] + [f"data: {line}" for line in str(data).split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+
+class EventChannel:
+    """ Fans state change events out to every connected Server-Sent Events client
+
+    Events are published onto a single queue and a dispatcher thread formats each one once before handing it to
+    every client's backlog. Pages re-fetch their fragments when an event names them, and those fetches are
+    answered from the FragmentCache, so each fragment is rendered once per event however many clients listen.
+    Clients which fall `CLIENT_BACKLOG` events behind are dropped; their browsers reconnect and refresh. Under the
+    async server (serving.py) a client waits for events on the event loop, holding no thread while it is idle.
+    """
+    def __init__(self):
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.dispatcher = None
+
+    def publish(self, event, data=""):
+        self.events.put((event, data))
+        with self.lock:
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self.dispatch, name="EventChannel", daemon=True)
+                self.dispatcher.start()
+
+    def publishObserverEvent(self, observer, event):
+        self.publish(event)
+
+    def dispatch(self):
+        while True:
+            message = formatEvent(*self.events.get())
+            with self.lock:
+                clients = list(self.clients)
+            for client in clients:
+                try:
+                    client.put_nowait(message)
+                except queue.Full:
+                    self.unsubscribe(client)
+
+    def subscribe(self, client=None):
+        if client is None:
+            client = queue.Queue(maxsize=CLIENT_BACKLOG)
+        with self.lock:
+            self.clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def stream(self):
+        client = self.subscribe()
+        try:
+            yield "retry: 2000\n\n"
+            while True:
+                try:
+                    yield client.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    with self.lock:
+                        if client not in self.clients:
+                            return
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(client)
+
+    async def streamOnLoop(self, client):
+        try:
+            yield "retry: 2000\n\n"
+            while True:
+                try:
+                    yield await asyncio.wait_for(client.messages.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    with self.lock:
+                        if client not in self.clients:
+                            return
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(client)
+
+    def respond(self):
+        loop = request.environ.get(LOOP_ENVIRON_KEY)
+        if loop is not None:
+            request.environ[ASYNC_BODY_ENVIRON_KEY] = self.streamOnLoop(self.subscribe(LoopClient(loop)))
+            body = []
+        else:
+            body = self.stream()
+        response = Response(body, mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+
+EVENTS = EventChannel()
+
+
+def publishObserverEvents(observerClass):
+    """ Publish every observer stateChanged() on the shared channel """
+    if EVENTS.publishObserverEvent not in observerClass.stateListeners:
+        observerClass.stateListeners.append(EVENTS.publishObserverEvent)
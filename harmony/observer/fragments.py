@@ -0,0 +1,46 @@
+import threading
+from hashlib import md5
+from uuid import uuid4
+
+from flask import Response, request
+
+
+# Distinguishes ETags issued before a restart, when state versions start counting again
+BOOT_ID = uuid4().hex
+
+
+class FragmentCache:
+    """ Memoizes polled htmx fragments by the state version they were rendered against
+
+    Each fragment is identified by a key (endpoint and arguments) and a version (any hashable describing the state
+    the fragment depends on). A fragment is rendered at most once per version, and polls whose If-None-Match
+    already names that version get an empty 304. The browser then hands htmx its cached copy, which is always the
+    right content, even for a freshly loaded page whose targets are still empty.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fragments = {}
+
+    @staticmethod
+    def etag(key, version):
+        return md5(repr((BOOT_ID, key, version)).encode()).hexdigest()
+
+    def render(self, key, version, renderer):
+        with self.lock:
+            cached = self.fragments.get(key, None)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        body = renderer()
+        with self.lock:
+            self.fragments[key] = (version, body)
+        return body
+
+    def respond(self, key, version, renderer):
+        etag = self.etag(key, version)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.render(key, version, renderer), mimetype="text/html")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
@@ -0,0 +1,119 @@
+import os
+import resource
+
+from flask import Response
+
+
+METRICS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+RECENT_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatLabels(**labels):
+    labels = [f'{name}="{escapeLabel(value)}"' for name, value in labels.items() if value is not None]
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def metricHeader(name, metricType, description):
+    return [f"# HELP {name} {description}", f"# TYPE {name} {metricType}"]
+
+
+def quantile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def stageTimingMetrics(timings):
+    series = sorted(timings.snapshot().items(), key=lambda item: (item[0][0], item[0][1] or ""))
+    lines = metricHeader("harmony_cycle_stage_seconds", "histogram", "Time spent in each stage of the observer cycle")
+    for (stage, camera), data in series:
+        for bound, count in zip(timings.buckets, data["buckets"]):
+            lines.append(f"harmony_cycle_stage_seconds_bucket{formatLabels(stage=stage, camera=camera, le=bound)} {count}")
+        lines.append(f"harmony_cycle_stage_seconds_bucket{formatLabels(stage=stage, camera=camera, le='+Inf')} {data['count']}")
+        lines.append(f"harmony_cycle_stage_seconds_sum{formatLabels(stage=stage, camera=camera)} {data['sum']}")
+        lines.append(f"harmony_cycle_stage_seconds_count{formatLabels(stage=stage, camera=camera)} {data['count']}")
+
+    lines += metricHeader(
+        "harmony_cycle_stage_recent_seconds", "gauge", "Quantiles of each stage over its most recent samples")
+    for (stage, camera), data in series:
+        if not data["recent"]:
+            continue
+        for q in RECENT_QUANTILES:
+            value = quantile(data["recent"], q)
+            lines.append(f"harmony_cycle_stage_recent_seconds{formatLabels(stage=stage, camera=camera, quantile=q)} {value}")
+    return lines
+
+
+def streamMetrics(streamCache, blueprint):
+    with streamCache.lock:
+        views = sorted(streamCache.stats.items())
+    metrics = [
+        ("harmony_stream_clients", "gauge", "Connected MJPEG clients", "clients"),
+        ("harmony_stream_frames_served_total", "counter", "MJPEG frames sent to clients", "framesServed"),
+        ("harmony_stream_encodes_total", "counter", "Frames rendered and JPEG encoded", "encodes"),
+        ("harmony_stream_encode_seconds_total", "counter", "Time spent JPEG encoding frames", "encodeSeconds")]
+    lines = []
+    for name, metricType, description, attribute in metrics:
+        lines += metricHeader(name, metricType, description)
+        for view, stats in views:
+            lines.append(f"{name}{formatLabels(blueprint=blueprint, view=view)} {getattr(stats, attribute)}")
+    return lines
+
+
+def schedulerMetrics(scheduler):
+    stats = scheduler.stats()
+    metrics = [
+        ("harmony_cycle_target_hz", "gauge", "Rate the capture cycle is scheduled at", "targetHz"),
+        ("harmony_cycle_achieved_hz", "gauge", "Rate the capture cycle actually ran at recently", "achievedHz"),
+        ("harmony_cycle_jitter_seconds", "gauge", "Standard deviation of the recent cycle period", "jitter"),
+        ("harmony_cycles_total", "counter", "Capture cycles run", "cycles"),
+        ("harmony_cycle_overruns_total", "counter", "Capture cycles which ran past their slot", "overruns")]
+    lines = []
+    for name, metricType, description, key in metrics:
+        lines += metricHeader(name, metricType, description)
+        lines.append(f"{name} {float(stats[key])}")
+    return lines
+
+
+def processMetrics():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    lines = metricHeader("process_cpu_seconds_total", "counter", "User and system CPU time of the server process")
+    lines.append(f"process_cpu_seconds_total {usage.ru_utime + usage.ru_stime}")
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as f:
+            residentPages = int(f.read().split()[1])
+        lines += metricHeader("process_resident_memory_bytes", "gauge", "Resident memory of the server process")
+        lines.append(f"process_resident_memory_bytes {residentPages * os.sysconf('SC_PAGE_SIZE')}")
+    return lines
+
+
+def startupMetrics(readiness):
+    lines = metricHeader("harmony_ready", "gauge", "Whether the cameras have warmed up and the observer is built")
+    lines.append(f"harmony_ready {float(readiness.ready.is_set())}")
+    metrics = [
+        ("harmony_time_to_first_response_seconds", "Seconds from process start to the first HTTP response",
+         readiness.firstResponseSeconds),
+        ("harmony_time_to_ready_seconds", "Seconds from process start to the end of the camera warm up",
+         readiness.readySeconds)]
+    for name, description, value in metrics:
+        if value is not None:
+            lines += metricHeader(name, "gauge", description)
+            lines.append(f"{name} {value}")
+    return lines
+
+
+def metricsResponse(timings, streamCache=None, blueprint=None, scheduler=None, readiness=None):
+    """ Prometheus text exposition of cycle stage timings, stream counters, the capture scheduler, start up and the
+    process """
+    lines = stageTimingMetrics(timings)
+    if streamCache is not None:
+        lines += streamMetrics(streamCache, blueprint)
+    if scheduler is not None:
+        lines += schedulerMetrics(scheduler)
+    if readiness is not None:
+        lines += startupMetrics(readiness)
+    lines += processMetrics()
+    return Response("\n".join(lines) + "\n", mimetype=METRICS_MIMETYPE)
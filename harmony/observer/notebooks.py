@@ -0,0 +1,163 @@
+import argparse
+import hashlib
+import json
+import marshal
+import os
+import subprocess
+import sys
+import tempfile
+from importlib.util import MAGIC_NUMBER, find_spec, module_from_spec
+
+
+NOTEBOOK_CACHE = os.getenv("HARMONY_NOTEBOOK_CACHE", "1").lower() not in ["0", "false", "no"]
+CACHE_DIRECTORY = "__pycache__"
+NOTEBOOK_PACKAGE = "ipynb.fs.full"
+
+
+def registerNotebookPackage():
+    """ Register ipynb.fs without running it outside of Jupyter
+
+    Its __init__ imports IPython, taking around half a second, only to help relative imports from a live notebook.
+    """
+    if not NOTEBOOK_CACHE or "ipynb.fs" in sys.modules or "IPython" in sys.modules:
+        return
+    import ipynb
+    ipynb.fs = sys.modules["ipynb.fs"] = module_from_spec(find_spec("ipynb.fs"))
+
+
+registerNotebookPackage()
+
+from ipynb.fs.finder import FSFinder
+from ipynb.fs.full import FullLoader
+from ipynb.utils import code_from_ipynb, validate_nb
+
+
+def cachePaths(notebookPath, digest):
+    """ Where a notebook's compiled code is cached, and the prefix shared by its caches for other versions """
+    directory, fileName = os.path.split(notebookPath)
+    prefix = os.path.join(directory, CACHE_DIRECTORY, fileName[:-len(".ipynb")] + ".")
+    return f"{prefix}{digest}.pyc", prefix
+
+
+def writeCache(path, prefix, code):
+    """ Atomically replace the cached code of a notebook, dropping the caches of its earlier versions """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as f:
+            f.write(MAGIC_NUMBER + marshal.dumps(code))
+        os.replace(f.name, path)
+        for fileName in os.listdir(directory):
+            stale = os.path.join(directory, fileName)
+            if stale.startswith(prefix) and stale.endswith(".pyc") and stale != path:
+                os.remove(stale)
+    except OSError as e:
+        # A read-only checkout still imports, it just compiles every time
+        print(f"Unable to cache {path}: {e}")
+
+
+def compileNotebook(path):
+    """ The code of a notebook's code cells, exactly as ipynb.fs.full builds it, cached by the notebook's content """
+    with open(path, "rb") as f:
+        source = f.read()
+    cached, prefix = cachePaths(path, hashlib.sha256(source).hexdigest()[:16])
+    try:
+        with open(cached, "rb") as f:
+            data = f.read()
+        if data[:len(MAGIC_NUMBER)] == MAGIC_NUMBER:
+            return marshal.loads(data[len(MAGIC_NUMBER):])
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    try:
+        nb = json.loads(source)
+    except ValueError:
+        raise ImportError(f"Could not import {path}: not a valid ipynb file")
+    if not validate_nb(nb):
+        raise ImportError(f"Could not import {path}: incorrect version or language")
+    code = compile(code_from_ipynb(nb), path, "exec", dont_inherit=True)
+    writeCache(cached, prefix, code)
+    return code
+
+
+class CachedNotebookLoader(FullLoader):
+    """ ipynb's notebook loader, reusing byte-compiled code until the notebook changes """
+    def get_code(self, fullname):
+        if self.path.endswith(".ipynb"):
+            return compileNotebook(self.path)
+        return super().get_code(fullname)
+
+
+class NotebookCacheFinder(FSFinder):
+    """ Finds `ipynb.fs.full.X` notebooks the way ipynb does, ahead of its own finder """
+    def find_spec(self, fullname, path, target=None):
+        if fullname.startswith(self.package_prefix + "."):
+            return super().find_spec(fullname, path, target)
+        return None
+
+
+def installNotebookCache():
+    """ Serve notebook imports from the cache. Idempotent, as this module may be imported under two names """
+    if NOTEBOOK_CACHE and not any(type(finder).__name__ == "NotebookCacheFinder" for finder in sys.meta_path):
+        sys.meta_path.insert(0, NotebookCacheFinder(NOTEBOOK_PACKAGE, CachedNotebookLoader))
+
+
+def compileNotebooks(paths):
+    """ Build step: fill the cache for every notebook under `paths` """
+    for root in paths:
+        for directory, directories, fileNames in os.walk(root):
+            directories[:] = [d for d in directories if d not in [".ipynb_checkpoints", CACHE_DIRECTORY, ".git"]]
+            for fileName in sorted(fileNames):
+                if fileName.endswith(".ipynb"):
+                    notebook = os.path.join(directory, fileName)
+                    try:
+                        compileNotebook(notebook)
+                        print(f"Compiled {notebook}")
+                    except (ImportError, SyntaxError) as e:
+                        print(f"Skipped {notebook}: {e}")
+
+
+def timeColdStart(module, cache, repeats):
+    """ Seconds to import `module` in fresh interpreters, with or without the notebook cache """
+    environment = dict(os.environ, HARMONY_NOTEBOOK_CACHE="1" if cache else "0")
+    script = "; ".join([
+        "import sys, importlib",
+        "from time import perf_counter",
+        "sys.path.insert(0, '')",
+        f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})",
+        "start = perf_counter()",
+        "import notebooks",
+        f"importlib.import_module({module!r})",
+        "print(perf_counter() - start)"])
+    samples = []
+    for i in range(repeats):
+        result = subprocess.run([sys.executable, "-c", script], env=environment, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception(f"Importing {module} failed:\n{result.stderr}")
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return min(samples)
+
+
+installNotebookCache()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='NotebookCache',
+        description='Byte-compiles notebooks for `ipynb.fs.full` imports, or measures cold start with and without')
+    commands = parser.add_subparsers(dest="command", required=True)
+    compileCommand = commands.add_parser("compile", help="Compile every notebook under the given directories")
+    compileCommand.add_argument("paths", nargs="*", default=["."])
+    timeCommand = commands.add_parser("time", help="Time importing modules in fresh interpreters")
+    timeCommand.add_argument("modules", nargs="+", help="e.g. observer harmonyServer")
+    timeCommand.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        compileNotebooks(args.paths)
+    else:
+        for module in args.modules:
+            uncached = timeColdStart(module, False, args.repeats)
+            timeColdStart(module, True, 1)  # Fill the cache
+            cached = timeColdStart(module, True, args.repeats)
+            print(f"{module}: {uncached:.2f}s without the notebook cache, {cached:.2f}s with it")
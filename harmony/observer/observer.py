@@ -2,20 +2,25 @@ import os
 import cv2
 from math import ceil
 import numpy as np
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
 import base64
-import argparse
 import json
-from io import BytesIO 
 
 import threading
 import atexit
-from flask import Flask, Blueprint, render_template, Response, request, make_response, redirect, url_for
+from flask import Flask, Blueprint, render_template, request, make_response, redirect, url_for
 from traceback import format_exc
 
 from configurator import configurator, setConfiguratorApp
-from calibrator import calibrator, CalibratedObserver, CalibratedCaptureConfiguration, registerCaptureService, DATA_LOCK
+from calibrator import calibrator, CalibratedObserver, CalibratedCaptureConfiguration, registerCaptureService, DATA_LOCK, vStackImages, CYCLE_TIMINGS
+from overlays import paintChanges
+from templating import Template, TEMPLATES
+from thumbnails import thumbnailURL, thumbnailResponse
+from fragments import FragmentCache
+from streams import StreamCache
+from events import EVENTS
+from statics import mountStaticAssets
+from serving import runServer
+from metrics import metricsResponse
 
 app = None
 
@@ -25,6 +30,8 @@ PORT = int(os.getenv("OBSERVER_PORT", "7000"))
 
 
 observer = Blueprint('observer', __name__, template_folder='templates')
+fragments = FragmentCache()
+streams = StreamCache()
 
 
 def imageToBase64(img):
@@ -32,140 +39,78 @@ def imageToBase64(img):
 
 
 def renderConsole():
-    while True:
-        cam = list(app.cc.cameras.values())[0]
-        shape = (170, 400)
-        mid = [int(d / 2) for d in shape]
-        zeros = np.zeros(shape, dtype="uint8")
-
-        consoleImage = cv2.putText(zeros, f'Cycle {app.cm.cycleCounter}',
-            (50, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        consoleImage = cv2.putText(zeros, f'Mode: {app.cm.mode:7}',
-            (50, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        consoleImage = cv2.putText(zeros, f'Board State: {app.cm.state:10}',
-            (50, 105), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-        consoleImage = cv2.putText(zeros, f'LO: {CONSOLE_OUTPUT}',
-            (50, 145), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
-
-        ret, consoleImage = cv2.imencode('.jpg', zeros)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + consoleImage.tobytes() + b'\r\n')
+    cam = list(app.cc.cameras.values())[0]
+    shape = (170, 400)
+    mid = [int(d / 2) for d in shape]
+    zeros = np.zeros(shape, dtype="uint8")
+    snapshot = app.cm.snapshot
+
+    consoleImage = cv2.putText(zeros, f'Cycle {snapshot.cycleCounter}',
+        (50, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    consoleImage = cv2.putText(zeros, f'Mode: {snapshot.mode:7}',
+        (50, 65), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    consoleImage = cv2.putText(zeros, f'Board State: {snapshot.state:10}',
+        (50, 105), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+    consoleImage = cv2.putText(zeros, f'LO: {CONSOLE_OUTPUT}',
+        (50, 145), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 255, 2, cv2.LINE_AA)
+
+    return zeros
 
 
 @observer.route('/observer_console', methods=['GET'])
 def getConsoleImage():
-    return Response(renderConsole(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("console", renderConsole)
 
 
-def genCombinedCamerasView():
-    while True:
-        camImages = []
-        for camName in app.cc.cameras.keys():
-            camImage = app.cc.cameras[camName].mostRecentFrame.copy()
-            camImages.append(camImage)
-        camImage = vStackImages(camImages)
-        camImage = cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+def renderCombinedCamerasView():
+    camImages = []
+    for camName in app.cc.cameras.keys():
+        camImages.append(app.cc.cameras[camName].mostRecentFrame)
+    return vStackImages(camImages, size=[480, 640])
 
 
 @observer.route('/combinedCameras')
 def combinedCamerasResponse():
-    return Response(genCombinedCamerasView(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("combinedCameras", renderCombinedCamerasView)
 
 
-def genCameraWithChangesView(camName):
-    camName = str(camName)
+def renderCameraWithChangesView(camName):
     cam = app.cc.cameras[camName]
-    while True:
-        if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-            print("Has changes")
-        if app.cm.lastClassification is not None:
-            print("Has class")
-        camImage = cam.cropToActiveZone(cam.mostRecentFrame.copy())
-        # Paint known objects blue
-        for memObj in app.cm.memory:
-            if memObj.changeSet[camName].changeType not in ['delete', None]:
-                memContour = np.array([memObj.changeSet[camName].changePoints], dtype=np.int32)
-                camImage = cv2.drawContours(camImage, memContour, -1, (255, 0, 0), -1)
-        # Paint last changes red
-        if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-            lastChange = app.cm.lastChanges.changeSet[camName]
-            if lastChange is not None and lastChange.changeType not in ['delete', None]:
-                lastChangeContour = np.array([lastChange.changePoints], dtype=np.int32)
-                camImage = cv2.drawContours(camImage, lastChangeContour, -1 , (0, 0, 255), -1)
-        # Paint classification green
-        if app.cm.lastClassification is not None and not app.cm.lastClassification.empty:
-            lastClass = app.cm.lastClassification.changeSet[camName]
-            if lastClass is not None and lastClass.changeType not in ['delete', None]:
-                lastClassContour = np.array([lastClass.changePoints], dtype=np.int32)
-                camImage = cv2.drawContours(camImage, lastClassContour, -1 , (0, 255, 0), -1)
-        camImage = cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+    camImage = cam.cropToActiveZone(cam.mostRecentFrame.copy())
+    camImage = paintChanges(app.cm.snapshot, camName, camImage)
+    return cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
 
 
 @observer.route('/camWithChanges/<camName>')
 def cameraViewWithChangesResponse(camName):
     if camName == "VirtualMap":
-        return Response(minimapGenerator(), mimetype='multipart/x-mixed-replace; boundary=frame')
-    return Response(genCameraWithChangesView(camName), mimetype='multipart/x-mixed-replace; boundary=frame')
+        return streams.respond("minimap", renderMinimap)
+    camName = str(camName)
+    return streams.respond(("camWithChanges", camName), lambda: renderCameraWithChangesView(camName))
 
 
-def fullCam(camName):
-    camName = str(camName)
-    cam = app.cc.cameras[camName]
-    while True:
-        camImage = cam.mostRecentFrame.copy()
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+def renderFullCam(camName):
+    return app.cc.cameras[camName].mostRecentFrame
 
 
 @observer.route('/fullCam/<camName>')
 def genFullCam(camName):
-    return Response(fullCam(camName), mimetype='multipart/x-mixed-replace; boundary=frame')
-
-
-def genCombinedCameraWithChangesView():
-    while True:
-        camImages = []
-        if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-            print("Has changes")
-        if app.cm.lastClassification is not None:
-            print("Has class")
-        for camName in app.cc.cameras.keys():
-            camImage = app.cc.cameras[camName].mostRecentFrame.copy()
-            # Paint known objects blue
-            for memObj in app.cm.memory:
-                if memObj.changeSet[camName].changeType not in ['delete', None]:
-                    memContour = np.array([memObj.changeSet[camName].changePoints], dtype=np.int32)
-                    camImage = cv2.drawContours(camImage, memContour, -1, (255, 0, 0), -1)
-            # Paint last changes red
-            if app.cm.lastChanges is not None and not app.cm.lastChanges.empty:
-                lastChange = app.cm.lastChanges.changeSet[camName]
-                if lastChange is not None and lastChange.changeType not in ['delete', None]:
-                    lastChangeContour = np.array([lastChange.changePoints], dtype=np.int32)
-                    camImage = cv2.drawContours(camImage, lastChangeContour, -1 , (0, 0, 255), -1)
-            # Paint classification green
-            if app.cm.lastClassification is not None and not app.cm.lastClassification.empty:
-                lastClass = app.cm.lastClassification.changeSet[camName]
-                if lastClass is not None and lastClass.changeType not in ['delete', None]:
-                    lastClassContour = np.array([lastClass.changePoints], dtype=np.int32)
-                    camImage = cv2.drawContours(camImage, lastClassContour, -1 , (0, 255, 0), -1)
-            camImages.append(camImage)
-        camImage = vStackImages(camImages)
-        camImage = cv2.resize(camImage, [480, 640], interpolation=cv2.INTER_AREA)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+    camName = str(camName)
+    return streams.respond(("fullCam", camName), lambda: renderFullCam(camName))
+
+
+def renderCombinedCameraWithChangesView():
+    camImages = []
+    for camName in app.cc.cameras.keys():
+        camImage = app.cc.cameras[camName].mostRecentFrame.copy()
+        camImage = paintChanges(app.cm.snapshot, camName, camImage)
+        camImages.append(camImage)
+    return vStackImages(camImages, size=[480, 640])
 
 
 @observer.route('/combinedCamerasWithChanges')
 def combinedCamerasWithChangesResponse():
-    return Response(genCombinedCameraWithChangesView(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("combinedCamerasWithChanges", renderCombinedCameraWithChangesView)
 
 
 @observer.route('/reset')
@@ -189,21 +134,35 @@ def controlSetTrack():
     return buildModeController()
 
 
-def buildModeController():
-    return """  <div class="btn-group" role="group" aria-label="Observer Capture Mode Control Buttons">
+modeControllerTemplate = Template("""  <div class="btn-group" role="group" aria-label="Observer Capture Mode Control Buttons">
                   <input type="radio" class="btn-check" name="btnradio" id="passive" autocomplete="off" {passiveChecked}hx-get="{observerURL}set_passive" hx-target="#modeController">
                   <label class="btn btn-outline-primary" for="passive">Passive</label>
                   <input type="radio" class="btn-check" name="btnradio" id="track" autocomplete="off" {activeChecked}hx-get="{observerURL}set_track" hx-target="#modeController">
                   <label class="btn btn-outline-primary" for="track">Track</label>
-                </div>""".replace(
-        "{observerURL}", url_for(".buildObserver")).replace(
-        "{passiveChecked}", 'checked=""' if app.cm.mode == "passive" else '').replace(
-        "{activeChecked}", 'checked=""' if app.cm.mode == "track" else '')
+                </div>""")
+
+
+def buildModeController():
+    return modeControllerTemplate.render(
+        observerURL=url_for(".buildObserver"),
+        passiveChecked='checked=""' if app.cm.snapshot.mode == "passive" else '',
+        activeChecked='checked=""' if app.cm.snapshot.mode == "track" else '')
 
 
 @observer.route('/get_mode_controller')
 def getModeController():
-    return buildModeController()
+    return fragments.respond("get_mode_controller", (id(app.cm), app.cm.stateVersion), buildModeController)
+
+
+@observer.route('/events')
+def getEvents():
+    return EVENTS.respond()
+
+
+@observer.route('/metrics')
+def getMetrics():
+    return metricsResponse(
+        CYCLE_TIMINGS, streams, "observer", getattr(app, "captureService", None), getattr(app, "readiness", None))
 
 
 @observer.route('/')
@@ -211,77 +170,70 @@ def buildObserver():
     if type(app.cm) is not CalibratedObserver:
         with DATA_LOCK:
             app.cm = CalibratedObserver(app.cc)
-    with open("templates/Observer.html", "r") as f:
-        template = f.read()
     cameraButtons = '<input type="button" value="Virtual Map" onclick="liveCameraClick(\'VirtualMap\')">' + ' '.join([f'''<input type="button" value="Camera {camName}" onclick="liveCameraClick('{camName}')">''' for camName in app.cc.cameras.keys()])
     defaultCam = [camName for camName, cam in app.cc.cameras.items()][0]
-    return template.replace(
-        "{defaultCamera}", defaultCam).replace(
-        "{cameraButtons}", cameraButtons).replace(
-        "{observerURL}", url_for('.buildObserver')).replace(
-        "{configuratorURL}", '/configurator')
+    return TEMPLATES.render("templates/Observer.html",
+        defaultCamera=defaultCam,
+        cameraButtons=cameraButtons,
+        observerURL=url_for('.buildObserver'),
+        configuratorURL='/configurator')
 
 
 def captureToChangeRow(capture):
-    encodedBA = imageToBase64(capture.visual())
-    name = "None"
-    objType = "None"
-    center = ", ".join(["0", "0"])
-    health = ""
-    numHits = 0
-    for i in range(numHits):
-        health += "[x] "
-    for i in range(3 - numHits):
-        health += "[ ] "
-    with open("templates/TrackedObjectRow.html") as f:
-        changeRowTemplate = f.read()
     moveDistance = app.cm.cc.rsc.trackedObjectLastDistance(capture)
     moveDistance = "None" if moveDistance is None else f"{moveDistance:6.0f} mm"
-    changeRow = changeRowTemplate.replace(
-        "{objectName}", capture.oid).replace(
-        "{realCenter}", ", ".join([f"{dim:6.0f}" for dim in app.cm.cc.rsc.changeSetToRealCenter(capture)])).replace(
-        "{moveDistance}", moveDistance).replace(
-        "{observerURL}", url_for(".buildObserver")).replace(
-        "{encodedBA}", imageToBase64(capture.visual()))
-    return changeRow
+    return TEMPLATES.render("templates/TrackedObjectRow.html",
+        objectName=capture.oid,
+        realCenter=", ".join([f"{dim:6.0f}" for dim in app.cm.cc.rsc.changeSetToRealCenter(capture)]),
+        moveDistance=moveDistance,
+        observerURL=url_for(".buildObserver"),
+        thumbnailURL=thumbnailURL(url_for(".buildObserver"), capture))
 
 
 def buildObjectTable():
     changeRows = []
-    print(f"Aware of {len(app.cm.memory)} objects")
-    for capture in app.cm.memory:
+    print(f"Aware of {len(app.cm.snapshot.memory)} objects")
+    for capture in app.cm.snapshot.memory:
         changeRows.append(captureToChangeRow(capture))
     return " ".join(changeRows)
 
 
 @observer.route('/objects', methods=['GET'])
 def getObjectTable():
-    return buildObjectTable()
+    return fragments.respond("objects", (id(app.cm), app.cm.stateVersion), buildObjectTable)
     
     
 @observer.route('/objects/<objectId>', methods=['GET'])
 def getObjectSettings(objectId):
     cap = None
-    for capture in app.cm.memory:
+    for capture in app.cm.snapshot.memory:
         if capture.oid == objectId:
             cap = capture
             break
     if cap is None:
         return f"{objectId} Not found", 404
 
-    objectName = cap.oid
-    observerURL = url_for(".buildObserver")
-    with open("templates/TrackedObjectUpdater.html") as f:
-        template = f.read()
-    return template.replace(
-        "{observerURL}", observerURL).replace(
-        "{objectName}", cap.oid)
+    return TEMPLATES.render("templates/TrackedObjectUpdater.html",
+        observerURL=url_for(".buildObserver"),
+        objectName=cap.oid)
+
+
+@observer.route('/objects/<objectId>/<kind>.jpg', methods=['GET'])
+def getObjectThumbnail(objectId, kind):
+    cap = None
+    for capture in app.cm.snapshot.memory:
+        if capture.oid == objectId:
+            cap = capture
+            break
+    if cap is None or kind not in ["thumb", "icon"]:
+        return f"{objectId} {kind} Not found", 404
+    return thumbnailResponse(cap, kind)
 
 
 @observer.route('/objects/<objectId>', methods=['POST'])
 def updateObjectSettings(objectId):
     cap = None
-    for capture in app.cm.memory:
+    for capture in app.cm.snapshot.memory:
         if capture.oid == objectId:
             cap = capture
             break
@@ -289,59 +241,57 @@ def updateObjectSettings(objectId):
         return f"{objectId} Not found", 404
     newName = request.form["objectName"]
     if newName != cap.oid:
-        cap.oid = newName
-    return f"""<div id="objectTable" hx-get="{url_for(".buildObserver")}/objects" hx-trigger="every 1s"></div>"""
+        with DATA_LOCK:
+            cap.oid = newName
+            app.cm.stateChanged()
+    return f"""<div id="objectTable" hx-get="{url_for(".buildObserver")}/objects" hx-trigger="load, objects-changed from:body"></div>"""
     
     
 @observer.route('/objects/<objectId>', methods=['DELETE'])
 def deleteObjectSettings(objectId):
-    app.cm.deleteObject(objectId)
-    return f"""<div id="objectTable" hx-get="{url_for(".buildObserver")}/objects" hx-trigger="every 1s"></div>"""
+    with DATA_LOCK:
+        app.cm.deleteObject(objectId)
+    return f"""<div id="objectTable" hx-get="{url_for(".buildObserver")}/objects" hx-trigger="load, objects-changed from:body"></div>"""
 
 
 @observer.route('/object_distances/<objectId>', methods=['GET'])
 def getObjectDistances(objectId):
     cap = None
-    for capture in app.cm.memory:
+    for capture in app.cm.snapshot.memory:
         if capture.oid == objectId:
             cap = capture
             break
     if cap is None:
         return f"{objectId} Not found", 404
 
-    with open("templates/ObjectDistanceCard.html") as f:
-        cardTemplate = f.read()
+    observerURL = url_for(".buildObserver")
+    cardTemplate = TEMPLATES.get("templates/ObjectDistanceCard.html")
     objDistCards = []
-    for target in app.cm.memory:
+    for target in app.cm.snapshot.memory:
         if target.oid == cap.oid:
             continue
         else:
-            objDistCards.append(cardTemplate.replace(
-                "{targetName}", target.oid).replace(
-                "{encodedBA}", imageToBase64(target.visual())).replace(
-                "{objectDistance}", f"{app.cm.cc.rsc.distanceBetweenObjects(cap, target):6.0f} mm"))
-                
-    with open("templates/ObjectDistanceTable.html") as f:
-        template = f.read()
-    return template.replace(
-        "{observerURL}", url_for(".buildObserver")).replace(
-        "{objectName}", cap.oid).replace(
-        "{objectDistanceCards}", "\n".join(objDistCards))
-
-
-def minimapGenerator():
-    while True:
-        camImage = app.cm.cc.buildMiniMap(
-            blueObjects=app.cm.memory,
-            greenObjects=[app.cm.lastClassification] if app.cm.lastClassification is not None else None)
-        ret, camImage = cv2.imencode('.jpg', camImage)
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpg\r\n\r\n' + camImage.tobytes() + b'\r\n')
+            objDistCards.append(cardTemplate.render(
+                targetName=target.oid,
+                thumbnailURL=thumbnailURL(observerURL, target),
+                objectDistance=f"{app.cm.cc.rsc.distanceBetweenObjects(cap, target):6.0f} mm"))
+
+    return TEMPLATES.render("templates/ObjectDistanceTable.html",
+        observerURL=observerURL,
+        objectName=cap.oid,
+        objectDistanceCards="\n".join(objDistCards))
+
+
+def renderMinimap():
+    snapshot = app.cm.snapshot
+    return app.cm.cc.buildMiniMap(
+        blueObjects=snapshot.memory,
+        greenObjects=[snapshot.lastClassification] if snapshot.lastClassification is not None else None)
     
 
 @observer.route('/minimap')
 def minimapResponse():
-    return Response(minimapGenerator(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return streams.respond("minimap", renderMinimap)
 
 
 def setObserverApp(newApp):
@@ -350,36 +300,24 @@ def setObserverApp(newApp):
 
 
 if __name__ == "__main__":
+    from startup import Readiness
+
+    def warmUp(app):
+        app.cc = CalibratedCaptureConfiguration()
+        app.cc.capture()
+        app.cm = CalibratedObserver(app.cc)
+        registerCaptureService(app)
+
     app = Flask(__name__)
-    app.cc = CalibratedCaptureConfiguration()
-    app.cc.capture()
     app.register_blueprint(observer, url_prefix='/observer')
     app.register_blueprint(configurator, url_prefix='/configurator')
-    app.cm = CalibratedObserver(app.cc)
     setConfiguratorApp(app)
 
     @app.route('/')
     def index():
         return redirect('/observer', code=303)
 
-    @app.route('/bootstrap.min.css', methods=['GET'])
-    def getBSCSS():
-        with open("templates/bootstrap.min.css", "r") as f:
-            bscss = f.read()
-        return Response(bscss, mimetype="text/css")
-    
-    @app.route('/bootstrap.min.js', methods=['GET'])
-    def getBSJS():
-        with open("templates/bootstrap.min.js", "r") as f:
-            bsjs = f.read()
-        return Response(bsjs, mimetype="application/javascript")
-    
-    @app.route('/htmx.min.js', methods=['GET'])
-    def getHTMX():
-        with open("templates/htmx.min.js", "r") as f:
-            htmx = f.read()
-        return Response(htmx, mimetype="application/javascript")
-    
-    registerCaptureService(app)
+    mountStaticAssets(app)
+    Readiness().install(app).warmUp(app, warmUp)
     print(f"Launching Observer Server on {PORT}")
-    app.run(host="0.0.0.0", port=PORT)
+    runServer(app, PORT)
@@ -0,0 +1,113 @@
+import threading
+
+import cv2
+import numpy as np
+
+
+MEMORY_COLOR = (255, 0, 0)
+LAST_CHANGE_COLOR = (0, 0, 255)
+CLASSIFICATION_COLOR = (0, 255, 0)
+
+
+def paintableChange(change):
+    return change is not None and change.changeType not in ['delete', None]
+
+
+class CameraOverlay:
+    """ Cached memory, last change and classification layers for a single camera
+
+    Each layer is a filled mask which is only redrawn when its source changes:
+        memory -- the snapshot's memory tuple, which is replaced whenever memoryVersion changes
+        lastChange -- the snapshot's lastChanges object
+        classification -- the snapshot's lastClassification object
+    The layers are flattened into a single color image and mask, so painting a frame costs one masked copy
+    regardless of how many objects are in memory.
+    """
+    layerOrder = ["memory", "lastChange", "classification"]
+    layerColors = {"memory": MEMORY_COLOR, "lastChange": LAST_CHANGE_COLOR, "classification": CLASSIFICATION_COLOR}
+
+    def __init__(self, camName):
+        self.camName = str(camName)
+        self.lock = threading.Lock()
+        self.shape = None
+        self.layerKeys = {}
+        self.layerMasks = {}
+        self.composite = None
+
+    def layerKey(self, layer, observer):
+        if layer == "memory":
+            return observer.memory
+        elif layer == "lastChange":
+            return observer.lastChanges
+        else:
+            return observer.lastClassification
+
+    def layerChanges(self, layer, observer):
+        if layer == "memory":
+            return [memObj.changeSet[self.camName] for memObj in observer.memory]
+        source = observer.lastChanges if layer == "lastChange" else observer.lastClassification
+        if source is None or source.empty:
+            return []
+        return [source.changeSet[self.camName]]
+
+    @staticmethod
+    def sameKey(key, other):
+        # ChangeSets define a fuzzy __eq__, so layer sources are compared by identity
+        return key is other
+
+    def buildLayerMask(self, layer, observer):
+        mask = np.zeros(self.shape, np.uint8)
+        for change in self.layerChanges(layer, observer):
+            if paintableChange(change):
+                contour = np.array([change.changePoints], dtype=np.int32)
+                cv2.drawContours(mask, contour, -1, 255, -1)
+        return mask
+
+    def buildComposite(self):
+        overlay = np.zeros((*self.shape, 3), np.uint8)
+        mask = np.zeros(self.shape, np.uint8)
+        for layer in self.layerOrder:
+            layerMask = self.layerMasks[layer]
+            overlay[layerMask > 0] = self.layerColors[layer]
+            mask = cv2.bitwise_or(mask, layerMask)
+        return overlay, mask
+
+    def refresh(self, observer, shape):
+        """ Rebuild any layers whose source has changed since the last refresh """
+        shape = tuple(shape[:2])
+        with self.lock:
+            if shape != self.shape:
+                self.shape = shape
+                self.layerKeys = {}
+            changed = False
+            for layer in self.layerOrder:
+                key = self.layerKey(layer, observer)
+                if layer in self.layerKeys and self.sameKey(key, self.layerKeys[layer]):
+                    continue
+                self.layerMasks[layer] = self.buildLayerMask(layer, observer)
+                self.layerKeys[layer] = key
+                changed = True
+            if changed or self.composite is None:
+                self.composite = self.buildComposite()
+            return self.composite
+
+    def paint(self, observer, frame):
+        """ Paint the cached layers onto `frame` in place and return it """
+        overlay, mask = self.refresh(observer, frame.shape)
+        return cv2.copyTo(overlay, mask, frame)
+
+
+CAMERA_OVERLAYS = {}
+CAMERA_OVERLAYS_LOCK = threading.Lock()
+
+
+def getCameraOverlay(camName):
+    camName = str(camName)
+    with CAMERA_OVERLAYS_LOCK:
+        if camName not in CAMERA_OVERLAYS:
+            CAMERA_OVERLAYS[camName] = CameraOverlay(camName)
+        return CAMERA_OVERLAYS[camName]
+
+
+def paintChanges(observer, camName, frame):
+    return getCameraOverlay(camName).paint(observer, frame)
@@ -0,0 +1,86 @@
+import os
+import sys
+import threading
+from collections import Counter
+from time import monotonic, sleep, strftime
+
+from flask import Response, request
+
+
+PROFILER_ENABLED = os.getenv("HARMONY_PROFILER", "0").lower() in ["1", "true", "yes"]
+DEFAULT_PROFILE_SECONDS = 10
+MAX_PROFILE_SECONDS = 120
+DEFAULT_SAMPLE_RATE = 100  # Hz
+MAX_SAMPLE_RATE = 1000  # Hz
+
+
+def frameName(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapseStack(threadName, frame):
+    """ A thread's stack in the collapsed format, root first: thread;outer;...;innermost """
+    names = []
+    while frame is not None:
+        names.append(frameName(frame))
+        frame = frame.f_back
+    names.append(threadName)
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """ Samples the stacks of every thread for a fixed time, e.g. the cycle scheduler, grabbers and stream generators
+
+    Nothing runs between profiles: sampling happens on the requesting thread, which leaves itself out of the
+    samples, and only one profile may run at a time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def sample(self, seconds, rate):
+        stacks = Counter()
+        samples = 0
+        ownThread = threading.get_ident()
+        interval = 1 / rate
+        end = monotonic() + seconds
+        nextSample = monotonic()
+        while nextSample < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != ownThread:
+                    stacks[collapseStack(names.get(ident, f"thread-{ident}"), frame)] += 1
+            samples += 1
+            nextSample += interval
+            now = monotonic()
+            if nextSample > now:
+                sleep(nextSample - now)
+            else:
+                nextSample = now
+        return stacks, samples
+
+    def profile(self, seconds, rate):
+        """ Collapsed stacks, one `stack count` line each, as read by flamegraph.pl and speedscope """
+        if not self.lock.acquire(blocking=False):
+            return None, 0
+        try:
+            stacks, samples = self.sample(seconds, rate)
+        finally:
+            self.lock.release()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()), samples
+
+    def respond(self):
+        if not PROFILER_ENABLED:
+            return "Profiler disabled, start the server with HARMONY_PROFILER=1", 404
+        seconds = min(MAX_PROFILE_SECONDS, max(0.1, request.args.get("seconds", DEFAULT_PROFILE_SECONDS, type=float)))
+        rate = min(MAX_SAMPLE_RATE, max(1, request.args.get("rate", DEFAULT_SAMPLE_RATE, type=float)))
+        collapsed, samples = self.profile(seconds, rate)
+        if collapsed is None:
+            return "A profile is already running", 409
+        response = Response(collapsed, mimetype="text/plain")
+        response.headers["Content-Disposition"] = f"attachment; filename=harmony-{strftime('%Y%m%d-%H%M%S')}.collapsed"
+        response.headers["X-Harmony-Profile-Samples"] = str(samples)
+        return response
+
+
+PROFILER = SamplingProfiler()
@@ -0,0 +1,124 @@
+import threading
+from collections import deque
+from traceback import format_exc
+from statistics import pstdev
+from time import monotonic
+
+
+CYCLE_RATE = 10  # Hz
+IDLE_RATE = 2  # Hz
+IDLE_AFTER = 30  # Seconds of stable board before dropping to IDLE_RATE
+STATS_WINDOW = 100  # Cycles
+
+
+class CycleScheduler:
+    """ Runs `cycle` on a single long-lived thread at a fixed rate
+
+    Cycles start on a deadline grid of 1 / rate seconds. A cycle which runs past its slot is counted as an overrun
+    and the missed slots are skipped rather than run back to back. Once `isIdle()` has held for `idleAfter` seconds
+    the scheduler drops to `idleRate`, returning to the full rate as soon as it stops holding or wake() is called.
+    """
+    def __init__(self, cycle, rate=CYCLE_RATE, idleRate=IDLE_RATE, idleAfter=IDLE_AFTER, isIdle=None,
+                 name="CycleScheduler"):
+        self.cycle = cycle
+        self.rate = rate
+        self.idleRate = idleRate
+        self.idleAfter = idleAfter
+        self.isIdle = isIdle
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.running = threading.Event()
+        self.woken = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.cycleStarts = deque(maxlen=STATS_WINDOW)
+        self.cycleCount = 0
+        self.overruns = 0
+        self.lastDuration = 0
+        self.stableSince = None
+        self.idle = False
+
+    def start(self):
+        self.running.set()
+        self.thread.start()
+        return self
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+        self.wake()
+
+    def wake(self):
+        """ Leave the idle rate and start the next cycle without waiting out the current slot """
+        with self.lock:
+            self.stableSince = None
+            self.idle = False
+        self.woken.set()
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        self.running.set()
+        self.woken.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
+
+    def updateIdle(self, now):
+        with self.lock:
+            if self.isIdle is None or not self.isIdle():
+                self.stableSince = None
+                self.idle = False
+            elif self.stableSince is None:
+                self.stableSince = now
+            else:
+                self.idle = now - self.stableSince >= self.idleAfter
+            return self.idle
+
+    def interval(self):
+        return 1 / (self.idleRate if self.idle else self.rate)
+
+    def run(self):
+        nextCycle = monotonic()
+        while not self.stopping.is_set():
+            if not self.running.is_set():
+                self.running.wait()
+                nextCycle = monotonic()
+                continue
+            self.woken.clear()
+            cycleStart = monotonic()
+            try:
+                self.cycle()
+            except Exception:
+                print(f"Scheduled cycle failed:\n{format_exc()}")
+            cycleEnd = monotonic()
+            with self.lock:
+                self.cycleStarts.append(cycleStart)
+                self.cycleCount += 1
+                self.lastDuration = cycleEnd - cycleStart
+            self.updateIdle(cycleEnd)
+            nextCycle += self.interval()
+            if nextCycle < cycleEnd:
+                with self.lock:
+                    self.overruns += 1
+                nextCycle = cycleEnd
+            if self.woken.wait(nextCycle - cycleEnd):
+                nextCycle = monotonic()
+
+    def stats(self):
+        """ Target and achieved rate (Hz), jitter (standard deviation of the cycle period, seconds) and counters """
+        with self.lock:
+            starts = list(self.cycleStarts)
+            periods = [later - earlier for earlier, later in zip(starts, starts[1:])]
+            return {
+                "targetHz": self.idleRate if self.idle else self.rate,
+                "achievedHz": len(periods) / (starts[-1] - starts[0]) if len(periods) > 0 and starts[-1] > starts[0] else 0,
+                "jitter": pstdev(periods) if len(periods) > 1 else 0,
+                "lastDuration": self.lastDuration,
+                "cycles": self.cycleCount,
+                "overruns": self.overruns,
+                "idle": self.idle,
+                "paused": self.paused}
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import monotonic
+
+
+SERVER_MODE = os.getenv("HARMONY_SERVER", "dev").lower()
+WORKER_THREADS = int(os.getenv("HARMONY_WORKER_THREADS", "16"))
+# Named by streams which leave their pacing to the event loop, rather than sleeping in their generator
+FRAME_INTERVAL_HEADER = "X-Harmony-Frame-Interval"
+# The environ holds the event loop serving a request, and a response may leave an async iterator of its body there
+LOOP_ENVIRON_KEY = "harmony.loop"
+ASYNC_BODY_ENVIRON_KEY = "harmony.asyncBody"
+
+
+def buildEnviron(scope, body, loop=None):
+    """ Translate an ASGI http scope and its request body into a WSGI environ """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "harmony.async": True,
+        LOOP_ENVIRON_KEY: loop}
+    for name, value in scope["headers"]:
+        name, value = name.decode("latin1"), value.decode("latin1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsyncStreamingApp:
+    """ ASGI application holding a Flask app's long-lived streams on an event loop
+
+    Each request is handed to the Flask app on a small thread pool, exactly as a threaded WSGI server would, so the
+    blueprints, url_for and DATA_LOCK behave as they do under app.run(). The response body is then drained from the
+    event loop: every chunk is pulled on the pool, and streams naming a frame interval (see streams.py) wait it out
+    on the loop. An open camera view therefore holds a thread only while a frame is rendered, rather than for its
+    whole lifetime. Responses which wait on events rather than render, such as Server-Sent Events, leave an async
+    iterator under ASYNC_BODY_ENVIRON_KEY and are drained entirely on the loop.
+    """
+    def __init__(self, wsgiApp, workers=WORKER_THREADS):
+        self.wsgiApp = wsgiApp
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="harmonyWorker")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def readBody(receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                return body
+
+    @staticmethod
+    async def watchDisconnect(receive, disconnected):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+
+    def callApplication(self, environ):
+        started = {}
+
+        def startResponse(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = headers
+            return lambda data: None
+
+        body = self.wsgiApp(environ, startResponse)
+        return started["status"], started["headers"], body
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        environ = buildEnviron(scope, await self.readBody(receive), loop)
+        status, headers, body = await loop.run_in_executor(self.executor, self.callApplication, environ)
+        asyncBody = environ.get(ASYNC_BODY_ENVIRON_KEY)
+        frameInterval = None
+        responseHeaders = []
+        for name, value in headers:
+            if name.lower() == FRAME_INTERVAL_HEADER.lower():
+                frameInterval = float(value)
+            else:
+                responseHeaders.append((name.lower().encode("latin1"), value.encode("latin1")))
+        await send({"type": "http.response.start", "status": status, "headers": responseHeaders})
+
+        disconnected = asyncio.Event()
+        watcher = asyncio.create_task(self.watchDisconnect(receive, disconnected))
+        try:
+            if asyncBody is not None:
+                await self.drainAsync(asyncBody, send, disconnected)
+            else:
+                await self.drain(loop, body, frameInterval, send, disconnected)
+            if not disconnected.is_set():
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            watcher.cancel()
+            if asyncBody is not None:
+                await asyncBody.aclose()
+            if hasattr(body, "close"):
+                await loop.run_in_executor(self.executor, body.close)
+
+    async def drain(self, loop, body, frameInterval, send, disconnected):
+        """ Send a WSGI body, pulling each chunk on the pool """
+        chunks = iter(body)
+        nextFrame = monotonic()
+        while not disconnected.is_set():
+            chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if frameInterval is None:
+                continue
+            nextFrame += frameInterval
+            now = monotonic()
+            if nextFrame > now:
+                await asyncio.sleep(nextFrame - now)
+            else:
+                nextFrame = now
+
+    @staticmethod
+    async def drainAsync(asyncBody, send, disconnected):
+        """ Send an async body without touching the pool, stopping as soon as the client disconnects """
+        waitDisconnect = asyncio.ensure_future(disconnected.wait())
+        try:
+            while True:
+                nextChunk = asyncio.ensure_future(asyncBody.__anext__())
+                await asyncio.wait([nextChunk, waitDisconnect], return_when=asyncio.FIRST_COMPLETED)
+                if not nextChunk.done():
+                    nextChunk.cancel()
+                    await asyncio.gather(nextChunk, return_exceptions=True)
+                    return
+                try:
+                    chunk = nextChunk.result()
+                except StopAsyncIteration:
+                    return
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            waitDisconnect.cancel()
+
+
+def runServer(app, port, host="0.0.0.0"):
+    """ Serve `app` with Flask's development server, or with HARMONY_SERVER=async from uvicorn """
+    if SERVER_MODE == "async":
+        import uvicorn
+        uvicorn.run(AsyncStreamingApp(app), host=host, port=port, lifespan="on")
+    else:
+        app.run(host=host, port=port)
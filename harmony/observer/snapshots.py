@@ -0,0 +1,298 @@
+import json
+import os
+import struct
+import threading
+from uuid import uuid4
+
+import cv2
+import numpy as np
+
+import notebooks  # Serves ipynb.fs.full imports from byte-compiled caches
+from ipynb.fs.full.Observer import CameraChange, TrackedObject
+
+
+SNAPSHOT_PATH = os.getenv("HARMONY_SNAPSHOT", "harmony.snapshot")
+RECORD_HEADER = struct.Struct("<4sI")  # Record kind, payload length
+META_LENGTH = struct.Struct("<I")
+# Compact once the log is this many times larger than the records still live in it
+COMPACT_RATIO = 4
+COMPACT_MINIMUM = 1 << 20  # bytes
+# TrackedObject attributes with their own place in a record, or rebuilt from the change set
+OBJECT_FIELDS = ["oid", "version", "snapshotKey"]
+
+
+def packRecord(kind, meta, blobs=()):
+    metaBytes = json.dumps(dict(meta, blobs=[len(blob) for blob in blobs])).encode()
+    payload = META_LENGTH.pack(len(metaBytes)) + metaBytes + b"".join(blobs)
+    return RECORD_HEADER.pack(kind, len(payload)) + payload
+
+
+def unpackPayload(payload):
+    (metaLength,) = META_LENGTH.unpack_from(payload)
+    offset = META_LENGTH.size + metaLength
+    meta = json.loads(payload[META_LENGTH.size:offset])
+    blobs = []
+    for size in meta["blobs"]:
+        blobs.append(payload[offset:offset + size])
+        offset += size
+    return meta, blobs
+
+
+def readRecords(path):
+    """ (kind, record bytes, payload) of every whole record in the log, ignoring a tail cut short by a crash """
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        kind, length = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end > len(data):
+            break
+        yield kind, data[offset:end], data[offset + RECORD_HEADER.size:end]
+        offset = end
+
+
+def encodeImage(image):
+    if image is None or image.size == 0:
+        return b""
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def decodeImage(data):
+    if len(data) == 0:
+        return np.zeros((0, 0, 3), dtype="uint8")
+    return cv2.imdecode(np.frombuffer(data, dtype="uint8"), cv2.IMREAD_UNCHANGED)
+
+
+def placeCrop(crop, contours):
+    """ A frame holding `crop` where CameraChange will cut it back out, so its constructor rebuilds the geometry """
+    x, y = np.concatenate([c.reshape(-1, 2) for c in contours]).min(axis=0).astype(int)
+    frame = np.zeros((y + crop.shape[0], x + crop.shape[1], *crop.shape[2:]), dtype=crop.dtype)
+    frame[y:, x:] = crop
+    return frame
+
+
+def nullChange():
+    return CameraChange(None, None, None, None, None)
+
+
+def encodeChange(change, blobs, withLastChange=True):
+    """ Describe a CameraChange, appending its contours and crops to `blobs`
+
+    Only one level of `lastChange` is kept, which is all TrackedObject.previousVersion reaches.
+    """
+    if change is None:
+        return None
+    if change.changeType is None:
+        return {"changeType": None}
+    described = {"camName": change.camName, "changeType": change.changeType, "contours": []}
+    for contour in change.changeContours:
+        blobs.append(np.ascontiguousarray(contour, dtype="int32").tobytes())
+        described["contours"].append(len(blobs) - 1)
+    for crop in ["before", "after"]:
+        blobs.append(encodeImage(getattr(change, crop)))
+        described[crop] = len(blobs) - 1
+    described["lastChange"] = encodeChange(change.lastChange, blobs, False) if withLastChange else None
+    return described
+
+
+def decodeChange(described, blobs):
+    if described is None:
+        return None
+    if described["changeType"] is None:
+        return nullChange()
+    contours = [np.frombuffer(blobs[i], dtype="int32").reshape(-1, 1, 2).copy() for i in described["contours"]]
+    change = CameraChange(
+        described["camName"], contours,
+        placeCrop(decodeImage(blobs[described["before"]]), contours),
+        placeCrop(decodeImage(blobs[described["after"]]), contours))
+    change.changeType = described["changeType"]
+    change.lastChange = decodeChange(described["lastChange"], blobs) or nullChange()
+    return change
+
+
+def objectAttributes(obj):
+    """ Settings given to an object from the UI, e.g. objectType, Class or Elevation """
+    return {key: value for key, value in vars(obj).items()
+            if key not in OBJECT_FIELDS and isinstance(value, (str, int, float, bool))}
+
+
+def objectSignature(obj):
+    return [obj.oid, obj.version, objectAttributes(obj)]
+
+
+class Snapshot:
+    def __init__(self):
+        self.objects = {}
+        self.order = []
+        self.game = None
+        self.graph = None
+
+    @property
+    def empty(self):
+        return len(self.objects) == 0 and self.game is None and self.graph is None
+
+    def memory(self):
+        ordered = [self.objects[key] for key in self.order if key in self.objects]
+        return ordered + [obj for key, obj in self.objects.items() if key not in self.order]
+
+
+class SnapshotLog:
+    """ An append only binary log of an Observer's memory, the game state and the game graph
+
+    Each record is a kind, a length and a payload of JSON metadata followed by binary blobs: contours as int32 and
+    image crops as PNG. After each commit only the objects whose version or settings changed are appended, and
+    deletions as tombstones. Graph writes are journaled as they are applied and appended as puts and drops with the
+    next commit; a whole edge list is written only when the graph is replaced or the log compacted. Loading replays
+    the log, then compacts it to the records still live.
+    """
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.signatures = {}  # snapshotKey -> objectSignature when last written
+        self.records = {}  # snapshotKey -> its latest record, as written
+        self.order = []
+        self.stateRecords = {}  # b"GAME" / b"ORDR" -> latest record
+        # The graph's edges once it is known, a dict used as an ordered set so a restore writes them in their order
+        self.edges = None
+        self.graphOperations = []  # Graph writes not yet appended
+        self.graphReplaced = False
+        self.graphSize = 0  # Approximate size of a record of self.edges
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def append(self, records):
+        if len(records) == 0:
+            return
+        with open(self.path, "ab") as f:
+            f.write(b"".join(records))
+        self.size += sum(len(record) for record in records)
+        liveSize = sum(len(record) for record in self.records.values()) + \
+            sum(len(record) for record in self.stateRecords.values()) + self.graphSize
+        if self.size > max(COMPACT_MINIMUM, COMPACT_RATIO * liveSize):
+            self.compact()
+
+    def compact(self):
+        """ Atomically rewrite the log as only its live records """
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(b"".join(self.records.values()) + b"".join(self.stateRecords.values()))
+            if self.edges is not None:
+                f.write(self.graphRecord())
+        os.replace(temporary, self.path)
+        self.size = os.path.getsize(self.path)
+
+    def graphRecord(self):
+        record = packRecord(b"GRPH", {"edges": list(self.edges)})
+        self.graphSize = len(record)
+        return record
+
+    def recordGraphWrite(self, operation, edge):
+        """ Journal a put or drop just applied to the graph, appended with the next commit """
+        with self.lock:
+            if self.edges is None:
+                self.edges = {}
+            if operation == "put" and edge not in self.edges:
+                self.edges[edge] = None
+                self.graphSize += len(json.dumps(edge))
+            elif operation == "drop" and edge in self.edges:
+                del self.edges[edge]
+                self.graphSize -= len(json.dumps(edge))
+            if not self.graphReplaced:
+                self.graphOperations.append([operation, *edge])
+
+    def recordGraphReset(self, edges):
+        """ The graph was replaced by one holding `edges` """
+        with self.lock:
+            self.edges = dict.fromkeys(tuple(edge) for edge in edges)
+            self.graphOperations = []
+            self.graphReplaced = True
+
+    def stateRecord(self, kind, meta):
+        """ A game state or memory order record, unless it is unchanged since the last one written """
+        record = packRecord(kind, meta)
+        if self.stateRecords.get(kind) == record:
+            return []
+        self.stateRecords[kind] = record
+        return [record]
+
+    def recordObserver(self, observer, game=None):
+        """ Append whatever changed in the observer's memory, the game state or graph since they were last written """
+        with self.lock:
+            records = []
+            keys = []
+            for obj in observer.memory:
+                if getattr(obj, "snapshotKey", None) is None:
+                    obj.snapshotKey = str(uuid4())
+                keys.append(obj.snapshotKey)
+                signature = objectSignature(obj)
+                if self.signatures.get(obj.snapshotKey) != signature:
+                    blobs = []
+                    changeSet = {camName: encodeChange(change, blobs) for camName, change in obj.changeSet.items()}
+                    record = packRecord(b"OBJ ", {
+                        "key": obj.snapshotKey, "oid": obj.oid, "version": obj.version,
+                        "attributes": objectAttributes(obj), "changeSet": changeSet}, blobs)
+                    self.signatures[obj.snapshotKey] = signature
+                    self.records[obj.snapshotKey] = record
+                    records.append(record)
+            for key in list(self.records):
+                if key not in keys:
+                    del self.records[key]
+                    del self.signatures[key]
+                    records.append(packRecord(b"DEL ", {"key": key}))
+            if keys != self.order:
+                self.order = keys
+                records += self.stateRecord(b"ORDR", {"order": keys})
+            if game is not None:
+                records += self.stateRecord(b"GAME", {"game": game})
+            if self.graphReplaced:
+                records.append(self.graphRecord())
+                self.graphReplaced = False
+            elif self.graphOperations:
+                records.append(packRecord(b"EDGE", {"operations": self.graphOperations}))
+                self.graphOperations = []
+            self.append(records)
+
+    def load(self):
+        """ The Snapshot the log holds, after which only changes made from here on are appended """
+        snapshot = Snapshot()
+        if not os.path.exists(self.path):
+            return snapshot
+        with self.lock:
+            for kind, record, payload in readRecords(self.path):
+                meta, blobs = unpackPayload(payload)
+                if kind == b"OBJ ":
+                    obj = TrackedObject({
+                        camName: decodeChange(change, blobs) for camName, change in meta["changeSet"].items()})
+                    obj.oid = meta["oid"]
+                    obj.version = meta["version"]
+                    obj.snapshotKey = meta["key"]
+                    for key, value in meta["attributes"].items():
+                        setattr(obj, key, value)
+                    snapshot.objects[obj.snapshotKey] = obj
+                    self.records[obj.snapshotKey] = record
+                    self.signatures[obj.snapshotKey] = objectSignature(obj)
+                elif kind == b"DEL ":
+                    snapshot.objects.pop(meta["key"], None)
+                    self.records.pop(meta["key"], None)
+                    self.signatures.pop(meta["key"], None)
+                elif kind in [b"ORDR", b"GAME"]:
+                    self.stateRecords[kind] = record
+                    if kind == b"ORDR":
+                        snapshot.order = meta["order"]
+                    else:
+                        snapshot.game = meta["game"]
+                elif kind == b"GRPH":
+                    self.edges = dict.fromkeys(tuple(edge) for edge in meta["edges"])
+                elif kind == b"EDGE":
+                    if self.edges is None:
+                        self.edges = {}
+                    for operation, *edge in meta["operations"]:
+                        if operation == "put":
+                            self.edges.setdefault(tuple(edge), None)
+                        else:
+                            self.edges.pop(tuple(edge), None)
+            if self.edges is not None:
+                snapshot.graph = list(self.edges)
+            self.order = [obj.snapshotKey for obj in snapshot.memory()]
+            self.compact()
+        return snapshot
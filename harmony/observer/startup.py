@@ -0,0 +1,88 @@
+import os
+import threading
+from time import monotonic
+from traceback import format_exc
+
+from flask import jsonify, request
+
+
+FAST_START = os.getenv("HARMONY_FAST_START", "1").lower() not in ["0", "false", "no"]
+# Served while the cameras warm up, none of them touch app.cc or app.cm
+WARMING_EXEMPT = ["ready", "metrics", "profile"]
+IMPORTED_AT = monotonic()
+
+
+def processAge():
+    """ Seconds since this process started, or since this module was imported where /proc is unavailable """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may hold spaces, the fields after it do not
+            startTicks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - startTicks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return monotonic() - IMPORTED_AT
+
+
+class Readiness:
+    """ Brings the HTTP server up before the cameras, answering with 503s until their warm-up has finished
+
+    Records how long after the process started it first answered a request, and when it became ready.
+    """
+    def __init__(self, fastStart=FAST_START):
+        self.fastStart = fastStart
+        self.ready = threading.Event()
+        self.error = None
+        self.firstResponseSeconds = None
+        self.readySeconds = None
+
+    def install(self, app):
+        app.readiness = self
+        app.before_request(self.holdUntilReady)
+        app.after_request(self.recordResponse)
+        app.add_url_rule("/ready", "ready", self.respond)
+        return self
+
+    def warmUp(self, app, build):
+        """ Run `build(app)`, which captures from the cameras and builds app.cm, in the background in fast start """
+        def run():
+            try:
+                build(app)
+            except Exception as e:
+                print(f"Warm up failed: {e}")
+                self.error = format_exc()
+                return
+            self.readySeconds = processAge()
+            self.ready.set()
+            print(f"Ready after {self.readySeconds:.2f}s")
+
+        if self.fastStart:
+            threading.Thread(target=run, name="warm-up", daemon=True).start()
+        else:
+            run()
+
+    def holdUntilReady(self):
+        if self.ready.is_set() or request.endpoint in ["ready", "static"]:
+            return None
+        if request.path.rstrip("/").rsplit("/", 1)[-1] in WARMING_EXEMPT:
+            return None
+        return "Cameras warming up", 503, {"Retry-After": "1"}
+
+    def recordResponse(self, response):
+        if self.firstResponseSeconds is None:
+            self.firstResponseSeconds = processAge()
+            print(f"First response after {self.firstResponseSeconds:.2f}s")
+        return response
+
+    def respond(self):
+        response = jsonify({
+            "ready": self.ready.is_set(),
+            "error": self.error,
+            "uptimeSeconds": processAge(),
+            "firstResponseSeconds": self.firstResponseSeconds,
+            "readySeconds": self.readySeconds})
+        if not self.ready.is_set():
+            response.status_code = 503
+            response.headers["Retry-After"] = "1"
+        return response
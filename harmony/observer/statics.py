@@ -0,0 +1,80 @@
+import gzip
+import os
+from hashlib import sha256
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_ASSETS = {
+    "bootstrap.min.css": "text/css",
+    "bootstrap.min.js": "application/javascript",
+    "htmx.min.js": "application/javascript"}
+# The assets are vendored, minified libraries which only change with a deploy
+STATIC_CACHE_CONTROL = "public, max-age=31536000"
+
+
+class StaticAsset:
+    """ A file loaded once, with its gzip (and, when available, brotli) encodings precomputed
+
+    Each encoding gets its own strong ETag, derived from the file's content, so caches never confuse them.
+    """
+    def __init__(self, path, mimetype):
+        self.path = path
+        self.mimetype = mimetype
+        with open(path, "rb") as f:
+            body = f.read()
+        self.etag = sha256(body).hexdigest()[:32]
+        self.encodings = {"identity": body}
+        compressed = {"gzip": gzip.compress(body, compresslevel=9)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(body)
+        for encoding, encoded in compressed.items():
+            if len(encoded) < len(body):
+                self.encodings[encoding] = encoded
+
+    def selectEncoding(self):
+        accepted = request.accept_encodings
+        for encoding in ["br", "gzip"]:
+            if encoding in self.encodings and accepted.quality(encoding) > 0:
+                return encoding
+        return "identity"
+
+    def respond(self):
+        encoding = self.selectEncoding()
+        etag = self.etag if encoding == "identity" else f"{self.etag}-{encoding}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.encodings[encoding], mimetype=self.mimetype)
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = STATIC_CACHE_CONTROL
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+
+class StaticAssets:
+    """ The shared css and javascript files, read from `directory` at startup and served from memory """
+    def __init__(self, directory="templates", assets=STATIC_ASSETS):
+        self.directory = directory
+        self.assets = {
+            name: StaticAsset(os.path.join(directory, name), mimetype)
+            for name, mimetype in assets.items()}
+
+    def mount(self, app):
+        """ Add a root level route for every asset, e.g. /htmx.min.js """
+        for name, asset in self.assets.items():
+            app.add_url_rule(
+                f"/{name}", endpoint=f"staticAsset_{name.replace('.', '_')}", view_func=asset.respond,
+                methods=["GET"])
+        return self
+
+
+def mountStaticAssets(app, directory="templates"):
+    return StaticAssets(directory).mount(app)
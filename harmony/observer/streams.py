@@ -0,0 +1,174 @@
+import os
+import threading
+from math import ceil
+from time import monotonic, perf_counter, sleep
+
+import cv2
+from flask import Response, request
+
+from serving import FRAME_INTERVAL_HEADER
+
+
+MJPEG_MIMETYPE = 'multipart/x-mixed-replace; boundary=frame'
+DEFAULT_STREAM_FPS = float(os.getenv("HARMONY_STREAM_FPS", "10"))
+DEFAULT_STREAM_QUALITY = 80
+MAX_STREAM_FPS = 30
+# Widths and qualities are rounded to these steps so that clients asking for similar streams share one variant
+STREAM_WIDTH_STEP = 160
+STREAM_QUALITY_STEP = 10
+
+
+def mjpegFrame(jpeg: bytes) -> bytes:
+    return b'--frame\r\nContent-Type: image/jpg\r\n\r\n' + jpeg + b'\r\n'
+
+
+class StreamSettings:
+    """ Client requested stream parameters
+
+    width -- downscale frames to this width, rounded up to a multiple of 160, keeping their aspect ratio. Frames are
+             never upscaled
+    quality -- JPEG quality, 1-100, rounded to a multiple of 10
+    fps -- target frame rate. Slow clients receive fewer frames rather than a backlog
+    """
+    def __init__(self, width=None, quality=DEFAULT_STREAM_QUALITY, fps=DEFAULT_STREAM_FPS):
+        self.width = None if width is None else STREAM_WIDTH_STEP * max(1, ceil(int(width) / STREAM_WIDTH_STEP))
+        quality = STREAM_QUALITY_STEP * round(int(quality) / STREAM_QUALITY_STEP)
+        self.quality = min(100, max(STREAM_QUALITY_STEP, quality))
+        self.fps = min(MAX_STREAM_FPS, max(0.1, float(fps)))
+
+    @classmethod
+    def fromRequest(cls):
+        return cls(
+            width=request.args.get("width", None, type=int),
+            quality=request.args.get("quality", DEFAULT_STREAM_QUALITY, type=int),
+            fps=request.args.get("fps", DEFAULT_STREAM_FPS, type=float))
+
+    @property
+    def frameInterval(self):
+        return 1 / self.fps
+
+
+class StreamStats:
+    """ Client, frame and encode counters for one view, summed over its variants """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = 0
+        self.framesServed = 0
+        self.encodes = 0
+        self.encodeSeconds = 0.0
+
+    def connected(self, change):
+        with self.lock:
+            self.clients += change
+
+    def served(self):
+        with self.lock:
+            self.framesServed += 1
+
+    def encoded(self, seconds):
+        with self.lock:
+            self.encodes += 1
+            self.encodeSeconds += seconds
+
+
+class StreamVariant:
+    """ The latest encoded frame of one view at one width and quality, shared by every client requesting it """
+    def __init__(self, renderer, width, quality, stats):
+        self.renderer = renderer
+        self.clients = 0  # Guarded by the StreamCache lock
+        self.width = width
+        self.quality = quality
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.renderedAt = None
+        self.jpeg = None
+
+    def encode(self, image):
+        if image is None:
+            return b""
+        if self.width is not None and image.shape[1] > self.width:
+            height = round(image.shape[0] * self.width / image.shape[1])
+            image = cv2.resize(image, [self.width, height], interpolation=cv2.INTER_AREA)
+        ret, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return jpeg.tobytes()
+
+    def latest(self, lastSequence, maxAge):
+        """ The newest frame, rendered afresh unless another client rendered one within `maxAge` seconds """
+        with self.lock:
+            now = monotonic()
+            if self.jpeg is None or self.sequence == lastSequence or now - self.renderedAt >= maxAge:
+                image = self.renderer()
+                encodeStart = perf_counter()
+                self.jpeg = self.encode(image)
+                self.stats.encoded(perf_counter() - encodeStart)
+                self.sequence += 1
+                self.renderedAt = now
+            return self.sequence, self.jpeg
+
+
+class StreamCache:
+    """ MJPEG responses built from shared StreamVariants, keyed by view and the client's width and quality
+
+    A variant is dropped, with its last frame, when its last client disconnects.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.variants = {}
+        self.stats = {}
+
+    @staticmethod
+    def viewName(key):
+        return key if type(key) is str else "/".join(str(part) for part in key)
+
+    def acquire(self, variantKey, renderer):
+        """ The variant for `variantKey`, created if no client holds it, with the caller counted among its clients """
+        key, width, quality = variantKey
+        with self.lock:
+            if variantKey not in self.variants:
+                viewName = self.viewName(key)
+                if viewName not in self.stats:
+                    self.stats[viewName] = StreamStats()
+                self.variants[variantKey] = StreamVariant(renderer, width, quality, self.stats[viewName])
+            variant = self.variants[variantKey]
+            variant.clients += 1
+        variant.stats.connected(1)
+        return variant
+
+    def release(self, variantKey, variant):
+        variant.stats.connected(-1)
+        with self.lock:
+            variant.clients -= 1
+            if variant.clients == 0 and self.variants.get(variantKey) is variant:
+                del self.variants[variantKey]
+
+    def frames(self, variantKey, renderer, settings, paced):
+        sequence = None
+        nextFrame = monotonic()
+        variant = self.acquire(variantKey, renderer)
+        try:
+            while True:
+                sequence, jpeg = variant.latest(sequence, settings.frameInterval)
+                yield mjpegFrame(jpeg)
+                variant.stats.served()
+                if not paced:
+                    continue
+                nextFrame += settings.frameInterval
+                now = monotonic()
+                if nextFrame > now:
+                    sleep(nextFrame - now)
+                else:
+                    # The client took longer than a frame to accept the last one, skip what it missed
+                    nextFrame = now
+        finally:
+            self.release(variantKey, variant)
+
+    def respond(self, key, renderer):
+        """ Stream `renderer()` images for view `key` at the width, quality and fps named in the request """
+        settings = StreamSettings.fromRequest()
+        variantKey = (key, settings.width, settings.quality)
+        loopPaced = request.environ.get("harmony.async", False)
+        response = Response(self.frames(variantKey, renderer, settings, paced=not loopPaced), mimetype=MJPEG_MIMETYPE)
+        if loopPaced:
+            response.headers[FRAME_INTERVAL_HEADER] = str(settings.frameInterval)
+        return response
@@ -0,0 +1,228 @@
+import argparse
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+import cv2
+import numpy as np
+
+import notebooks  # Serves ipynb.fs.full imports from byte-compiled caches
+from ipynb.fs.full.CalibratedObserver import RealSpaceConverter
+
+
+FRAME_SIZE = (1920, 1080)  # The size RemoteCamera resizes every capture to
+TABLE_BOUNDS = (50, 50, 1150, 1150)  # Real space (mm) x0, y0, x1, y1, inside the 1200mm minimap
+TABLE_COLOR = (40, 45, 40)
+OBJECT_SIZE = 30  # mm
+# Bright enough against the table to survive the grayscale difference threshold
+OBJECT_COLORS = [(255, 255, 255), (0, 255, 255), (255, 255, 0), (0, 200, 255), (200, 255, 200), (255, 200, 255)]
+CALIBRATION_TRIANGLE = [[600, 600], [300, 600], [600, 200]]
+
+
+class SceneObject:
+    def __init__(self, oid, x, y, size=OBJECT_SIZE, color=OBJECT_COLORS[0]):
+        self.oid = oid
+        self.x = x
+        self.y = y
+        self.size = size
+        self.color = tuple(color)
+
+    def corners(self):
+        half = self.size / 2
+        return np.float32([
+            [self.x - half, self.y - half], [self.x + half, self.y - half],
+            [self.x + half, self.y + half], [self.x - half, self.y + half]])
+
+    def describe(self):
+        return {"oid": self.oid, "x": self.x, "y": self.y, "size": self.size, "color": list(self.color)}
+
+
+def cameraTransform(index):
+    """ Real to camera similarity transform of the index'th synthetic camera, cameras alternate sides of the table """
+    scale = 0.9
+    angle = np.pi * (index % 2)
+    rotation = scale * np.float32([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    center = np.float32(FRAME_SIZE) / 2 + 20 * index
+    tableCenter = np.float32([(TABLE_BOUNDS[0] + TABLE_BOUNDS[2]) / 2, (TABLE_BOUNDS[1] + TABLE_BOUNDS[3]) / 2])
+    return lambda pt: rotation @ (np.float32(pt) - tableCenter) + center
+
+
+def syntheticConfiguration(cameraNames, baseAddress):
+    """ An observerConfiguration for cameras served by SceneServer, each seeing the whole table from its own side """
+    config = {}
+    rsc = []
+    x0, y0, x1, y1 = TABLE_BOUNDS
+    for index, camName in enumerate(cameraNames):
+        toCamera = cameraTransform(index)
+        activeZone = [toCamera(pt).round().astype(int).tolist() for pt in [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]]
+        config[camName] = {"addr": f"{baseAddress}/cam/{camName}", "rot": False, "az": json.dumps(activeZone)}
+        cameraTriangle = [toCamera(pt).round().astype(int).tolist() for pt in CALIBRATION_TRIANGLE]
+        rsc.append([camName, [cameraTriangle, CALIBRATION_TRIANGLE]])
+    config["rsc"] = rsc
+    return config
+
+
+def randomScript(objectCount, moves=0, removes=0, seed=0, size=OBJECT_SIZE):
+    """ Steps adding `objectCount` objects on a shuffled grid, then moving and removing some of them
+
+    Objects are placed on grid cells so that they never touch, and moves only go to free cells.
+    """
+    rng = random.Random(seed)
+    x0, y0, x1, y1 = TABLE_BOUNDS
+    perSide = int(np.ceil(np.sqrt(objectCount + moves)))
+    spacing = min(x1 - x0, y1 - y0) / perSide
+    cells = [(x0 + spacing * (i + 0.5), y0 + spacing * (j + 0.5)) for i in range(perSide) for j in range(perSide)]
+    rng.shuffle(cells)
+    steps = []
+    placed = {}
+    for oid in range(objectCount):
+        x, y = cells.pop()
+        placed[oid] = (x, y)
+        steps.append({"action": "add", "oid": oid, "x": x, "y": y, "size": size, "color": rng.choice(OBJECT_COLORS)})
+    for i in range(min(moves, len(cells))):
+        oid = rng.choice(list(placed))
+        cells.insert(0, placed[oid])
+        x, y = cells.pop()
+        placed[oid] = (x, y)
+        steps.append({"action": "move", "oid": oid, "x": x, "y": y})
+    for oid in rng.sample(list(placed), min(removes, len(placed))):
+        del placed[oid]
+        steps.append({"action": "remove", "oid": oid})
+    return steps
+
+
+class SyntheticScene:
+    """ Objects on a table, rendered as each camera of an rsc calibration would see them
+
+    Real space coordinates are projected into each camera through the inverse of the converter the observer would
+    use to map them back, so recognised objects land where the scene put them on the minimap.
+    """
+    def __init__(self, configuration, script=None):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.script = list(script or [])
+        self.position = 0
+        rsc = [[camName, [[np.array(pt, dtype="int32") for pt in cL] for cL in coordList]]
+               for camName, coordList in configuration["rsc"]]
+        self.rsc = RealSpaceConverter(rsc)
+        self.activeZones = {
+            camName: np.int32(json.loads(camDef["az"]))
+            for camName, camDef in configuration.items() if camName not in ["rsc", "calibrationPlan", "pov"]}
+        self.inverses = {
+            camName: [(np.linalg.inv(converter.M), converter.realSpaceCentroid) for converter in converters]
+            for camName, converters in self.rsc.converters.items()}
+
+    @property
+    def cameraNames(self):
+        return list(self.activeZones)
+
+    @property
+    def finished(self):
+        return self.position >= len(self.script)
+
+    def apply(self, step):
+        with self.lock:
+            if step["action"] == "add":
+                self.objects[step["oid"]] = SceneObject(
+                    step["oid"], step["x"], step["y"], step.get("size", OBJECT_SIZE), step.get("color", OBJECT_COLORS[0]))
+            elif step["action"] == "move":
+                self.objects[step["oid"]].x = step["x"]
+                self.objects[step["oid"]].y = step["y"]
+            elif step["action"] == "remove":
+                del self.objects[step["oid"]]
+            else:
+                raise Exception(f"Unrecognized scene action: {step}")
+
+    def step(self):
+        """ Apply the next step of the script, returning it, or None once the script is finished """
+        if self.finished:
+            return None
+        step = self.script[self.position]
+        self.position += 1
+        self.apply(step)
+        return step
+
+    def toCamera(self, camName, points):
+        center = points.mean(axis=0)
+        inverse = min(self.inverses[camName], key=lambda pair: np.linalg.norm(pair[1] - center))[0]
+        return cv2.perspectiveTransform(points.reshape(-1, 1, 2), inverse).reshape(-1, 2)
+
+    def render(self, camName):
+        image = np.zeros((FRAME_SIZE[1], FRAME_SIZE[0], 3), dtype="uint8")
+        image[:] = TABLE_COLOR
+        with self.lock:
+            objects = list(self.objects.values())
+        for obj in objects:
+            cv2.fillConvexPoly(image, np.int32(self.toCamera(camName, obj.corners()).round()), obj.color, cv2.LINE_AA)
+        return image
+
+    def jpeg(self, camName, quality=90):
+        ret, jpeg = cv2.imencode('.jpg', self.render(camName), [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return jpeg.tobytes()
+
+    def describe(self):
+        with self.lock:
+            return {"step": self.position, "steps": len(self.script),
+                    "objects": [obj.describe() for obj in self.objects.values()]}
+
+
+class SceneRequestHandler(BaseHTTPRequestHandler):
+    """ GET /cam/<camName> serves a frame as a RemoteCamera expects, /step advances the script, /state describes it """
+    scene = None
+
+    def send(self, body, contentType, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].strip("/").split("/")
+        if len(path) == 2 and path[0] == "cam" and path[1] in self.scene.cameraNames:
+            self.send(self.scene.jpeg(path[1]), "image/jpeg")
+        elif path == ["step"]:
+            self.send(json.dumps(self.scene.step()).encode(), "application/json")
+        elif path == ["state"]:
+            self.send(json.dumps(self.scene.describe()).encode(), "application/json")
+        else:
+            self.send(b"Not found", "text/plain", 404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def runScript(scene, stepSeconds):
+    while not scene.finished:
+        sleep(stepSeconds)
+        print(f"Scene step {scene.position + 1}/{len(scene.script)}: {scene.step()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='SyntheticScene',
+        description='Serves synthetic camera frames of a scripted tabletop in place of the camera services')
+    parser.add_argument("--cameras", nargs="+", default=["0", "1"])
+    parser.add_argument("--objects", type=int, default=50)
+    parser.add_argument("--moves", type=int, default=0)
+    parser.add_argument("--removes", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--step-seconds", type=float, default=4,
+                        help="Seconds between script steps, 0 to only step on GET /step")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=7100)
+    parser.add_argument("--config", default="syntheticConfiguration.json",
+                        help="Where to write the observer configuration for the synthetic cameras")
+    args = parser.parse_args()
+
+    configuration = syntheticConfiguration(args.cameras, f"http://{args.host}:{args.port}")
+    with open(args.config, "w") as f:
+        f.write(json.dumps(configuration, indent=2))
+    scene = SyntheticScene(configuration, randomScript(args.objects, args.moves, args.removes, args.seed))
+    SceneRequestHandler.scene = scene
+    if args.step_seconds > 0:
+        threading.Thread(target=runScript, args=(scene, args.step_seconds), daemon=True).start()
+    print(f"Serving {len(scene.cameraNames)} synthetic cameras on {args.port}, configuration in {args.config}")
+    ThreadingHTTPServer((args.host, args.port), SceneRequestHandler).serve_forever()
@@ -0,0 +1,82 @@
+import os
+import re
+import threading
+
+
+TEMPLATE_DIRECTORIES = ["templates", "harmony_templates"]
+TEMPLATE_EXTENSIONS = (".html",)
+TEMPLATE_RELOAD = os.getenv("HARMONY_TEMPLATE_RELOAD", "0").lower() in ["1", "true", "yes"]
+
+
+class Template:
+    """ A template pre-split into literal text and {placeholder} names
+
+    Rendering is a single pass over the parts. Placeholders without a value are left untouched, so braces used by
+    inline scripts (`${camNum}`, `{{ ... }}`) survive rendering.
+    """
+    placeholderPattern = re.compile(r"\{(\w+)\}")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.literals = []
+        self.placeholders = []
+        position = 0
+        for match in self.placeholderPattern.finditer(text):
+            self.literals.append(text[position:match.start()])
+            self.placeholders.append(match.group(1))
+            position = match.end()
+        self.literals.append(text[position:])
+
+    def render(self, **values) -> str:
+        parts = [self.literals[0]]
+        for name, literal in zip(self.placeholders, self.literals[1:]):
+            parts.append(str(values[name]) if name in values else "{" + name + "}")
+            parts.append(literal)
+        return "".join(parts)
+
+    def __repr__(self):
+        return f"Template({self.placeholders})"
+
+
+class TemplateRegistry:
+    """ Loads and parses every template under `directories` once
+
+    Templates are keyed by their path relative to the working directory, e.g. "templates/Observer.html". With
+    `reload` set, a template is re-read whenever its modification time changes, which is useful while editing pages.
+    """
+    def __init__(self, directories=TEMPLATE_DIRECTORIES, reload=TEMPLATE_RELOAD):
+        self.directories = directories
+        self.reload = reload
+        self.lock = threading.Lock()
+        self.templates = {}
+        self.mtimes = {}
+        self.load()
+
+    def load(self):
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for fileName in sorted(os.listdir(directory)):
+                if fileName.endswith(TEMPLATE_EXTENSIONS):
+                    self.loadTemplate(f"{directory}/{fileName}")
+
+    def loadTemplate(self, path):
+        with open(path, "r") as f:
+            template = Template(f.read())
+        with self.lock:
+            self.templates[path] = template
+            self.mtimes[path] = os.path.getmtime(path)
+        return template
+
+    def get(self, path) -> Template:
+        if path not in self.templates:
+            return self.loadTemplate(path)
+        if self.reload and os.path.getmtime(path) != self.mtimes[path]:
+            return self.loadTemplate(path)
+        return self.templates[path]
+
+    def render(self, path, **values) -> str:
+        return self.get(path).render(**values)
+
+
+TEMPLATES = TemplateRegistry()
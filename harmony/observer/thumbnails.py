@@ -0,0 +1,39 @@
+from hashlib import md5
+from uuid import uuid4
+
+from flask import Response, request
+
+from fragments import BOOT_ID
+
+
+THUMBNAIL_KINDS = {"thumb": "visual", "icon": "icon"}
+VERSIONED_CACHE_CONTROL = "public, max-age=31536000, immutable"
+UNVERSIONED_CACHE_CONTROL = "no-cache"
+
+
+def thumbnailToken(obj):
+    """ Names one object at one version, across restarts
+
+    Oids are chosen by users and may be reused by a new object, and versions restart at 0 for every object and every
+    process, so neither identifies the image on its own.
+    """
+    nonce = getattr(obj, "thumbnailNonce", None)
+    if nonce is None:
+        nonce = obj.thumbnailNonce = uuid4().hex[:12]
+    return f"{BOOT_ID[:12]}-{nonce}-{obj.version}"
+
+
+def thumbnailURL(baseURL, obj, kind="thumb"):
+    """ URL of an object's thumbnail, unique to its version so browsers can keep it until the object next updates """
+    return f"{baseURL}objects/{obj.oid}/{kind}.jpg?v={thumbnailToken(obj)}"
+
+
+def thumbnailResponse(obj, kind="thumb"):
+    """ Serve an object's cached JPEG with an ETag, answering 304 when the client's copy is current """
+    jpeg = obj.thumbnail(THUMBNAIL_KINDS[kind])
+    response = Response(jpeg, mimetype="image/jpeg")
+    response.set_etag(md5(jpeg).hexdigest())
+    requestedVersion = request.args.get("v", None)
+    response.headers["Cache-Control"] = \
+        VERSIONED_CACHE_CONTROL if requestedVersion == thumbnailToken(obj) else UNVERSIONED_CACHE_CONTROL
+    return response.make_conditional(request)
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import resource
+import tempfile
+from dataclasses import dataclass
+from statistics import mean
+from time import perf_counter
+
+from flask import Flask
+
+import observer  # Puts the observer notebooks on the import path
+from ipynb.fs.full.Observer import RemoteCamera, cameras, CYCLE_TIMINGS
+from ipynb.fs.full.CalibratedObserver import CalibratedCaptureConfiguration, CalibratedObserver
+from observer.observer import observer as observerBlueprint, setObserverApp, buildObjectTable
+from observer.syntheticScene import SyntheticScene, syntheticConfiguration, randomScript
+
+
+@dataclass
+class SceneCamera(RemoteCamera):
+    """ A RemoteCamera rendering its frames straight from a SyntheticScene """
+    scene: SyntheticScene = None
+
+    def collectImage(self):
+        with CYCLE_TIMINGS.time("capture", self.camName):
+            image = self.scene.render(self.camName)
+        self.imageBuffer.insert(0, image)
+        self.imageBuffer.pop()
+        return image
+
+
+def sceneConfiguration(scene, configuration):
+    path = os.path.join(tempfile.mkdtemp(), "observerConfiguration.json")
+    with open(path, "w") as f:
+        f.write(json.dumps(configuration))
+    cc = CalibratedCaptureConfiguration(path)
+    cameras.clear()
+    for camName, camDef in configuration.items():
+        if camName != "rsc":
+            cameras[camName] = SceneCamera(
+                camName=camName, activeZone=json.loads(camDef["az"]), address=camDef["addr"], scene=scene)
+    return cc
+
+
+def timed(function):
+    start = perf_counter()
+    result = function()
+    return perf_counter() - start, result
+
+
+def observeStep(cm, scene, step):
+    """ Apply a scene step and classify the change it makes, as a settled cycle would """
+    scene.apply(step)
+    cm.cc.capture()
+    return timed(lambda: cm.classifyChanges(cm.referenceFrameDeltas()))
+
+
+def populate(cm, scene, steps):
+    for step in steps:
+        classification = observeStep(cm, scene, step)[1]
+        cm.commitChanges(classification)
+        # Transitions keep full frames of every commit, far more memory than the objects being measured
+        cm.transitions.clear()
+        cm.cc.setReference()
+
+
+def probe(cm, scene, step, undo):
+    """ Time classifying `step` and scanning memory for its object, then put the scene back """
+    classifySeconds, classification = observeStep(cm, scene, step)
+    scanSeconds = timed(lambda: sum(obj == classification for obj in cm.memory))[0]
+    scene.apply(undo)
+    cm.cc.capture()
+    cm.cc.setReference()
+    return classifySeconds, scanSeconds
+
+
+def measure(cm, scene, app, spareSteps, repeats):
+    CYCLE_TIMINGS.reset()
+    adds, moves, scans = [], [], []
+    placed = list(scene.objects.values())
+    for i, spare in enumerate(spareSteps[:repeats]):
+        classifySeconds, scanSeconds = probe(cm, scene, spare, {"action": "remove", "oid": spare["oid"]})
+        adds.append(classifySeconds)
+        scans.append(scanSeconds)
+        moved = placed[i % len(placed)]
+        classifySeconds, scanSeconds = probe(
+            cm, scene, {"action": "move", "oid": moved.oid, "x": spare["x"], "y": spare["y"]},
+            {"action": "move", "oid": moved.oid, "x": moved.x, "y": moved.y})
+        moves.append(classifySeconds)
+        scans.append(scanSeconds)
+    overlaps = [series for (stage, camera), series in CYCLE_TIMINGS.snapshot().items() if stage == "overlap"]
+    minimapSeconds = timed(lambda: cm.cc.buildMiniMap(blueObjects=list(cm.memory)))[0]
+    with app.test_request_context("/observer/objects"):
+        cm.stateChanged()
+        tableSeconds = timed(buildObjectTable)[0]
+    return {
+        "objects": len(cm.memory),
+        "addClassifyMs": 1000 * mean(adds),
+        "moveClassifyMs": 1000 * mean(moves),
+        "overlapMs": 1000 * sum(s["sum"] for s in overlaps) / max(1, sum(s["count"] for s in overlaps)),
+        "memoryScanMs": 1000 * mean(scans),
+        "minimapMs": 1000 * minimapSeconds,
+        "objectTableMs": 1000 * tableSeconds,
+        "peakRssMb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='SceneBenchmark',
+        description='Measures how classification and rendering costs grow with the number of tracked objects')
+    parser.add_argument("--counts", nargs="+", type=int, default=[50, 200, 500])
+    parser.add_argument("--cameras", nargs="+", default=["0", "1"])
+    parser.add_argument("--repeats", type=int, default=5, help="Probe adds and moves at each count")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    counts = sorted(args.counts)
+    configuration = syntheticConfiguration(args.cameras, "http://synthetic")
+    script = randomScript(counts[-1] + args.repeats, seed=args.seed)
+    # The last adds of the script stay free, probes add objects to and move objects into their cells
+    steps, spareSteps = script[:counts[-1]], script[counts[-1]:]
+    scene = SyntheticScene(configuration)
+    cc = sceneConfiguration(scene, configuration)
+    cm = CalibratedObserver(cc)
+    cm.trackMode()
+
+    app = Flask(__name__)
+    app.cc = cc
+    app.cm = cm
+    app.register_blueprint(observerBlueprint, url_prefix='/observer')
+    setObserverApp(app)
+
+    results = []
+    populated = 0
+    print(f"{'objects':>8} {'add':>10} {'move':>10} {'overlap':>10} {'scan':>10} {'minimap':>10} {'table':>10} {'rss':>8}")
+    for count in counts:
+        populate(cm, scene, steps[populated:count])
+        populated = count
+        result = measure(cm, scene, app, spareSteps, args.repeats)
+        results.append(result)
+        print(f"{result['objects']:8} {result['addClassifyMs']:8.1f}ms {result['moveClassifyMs']:8.1f}ms "
+              f"{result['overlapMs']:8.1f}ms {result['memoryScanMs']:8.1f}ms {result['minimapMs']:8.1f}ms "
+              f"{result['objectTableMs']:8.1f}ms {result['peakRssMb']:6.0f}MB")
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(results, indent=2))